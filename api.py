@@ -1,25 +1,38 @@
+import asyncio
 import os
 from contextlib import asynccontextmanager
+from enum import StrEnum
+from typing import cast
 
 import aiohttp
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Response
-from tortoise import Tortoise
+from pydantic import BaseModel, Field
+from tortoise import Tortoise, connections
 
-from news_notify.models import Stock, User
+from news_notify.db import init_db
+from news_notify.metrics import REGISTRY, instrument_queries
+from news_notify.migrations import wait_for_schema
+from news_notify.models import Stock, User, bulk_add_relations
+from news_notify.stock_directory import StockDirectory, StockInfo
 
 load_dotenv()
 
+# concurrent lookups against the upstream stock API
+UPSTREAM_CONCURRENCY = 20
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await Tortoise.init(
-        db_url=os.getenv("DB_URL") or "sqlite://db.sqlite3",
-        modules={"models": ["news_notify.models"]},
-    )
-    await Tortoise.generate_schemas()
+    await init_db(os.getenv("DB_URL"), read_url=os.getenv("DB_READ_URL"))
+    instrument_queries(connections.get("default"))
+    # the bot process owns the schema and its migrations
+    await wait_for_schema()
     app.state.session = aiohttp.ClientSession()
+    app.state.upstream = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+    app.state.stocks = StockDirectory(fetch_stock)
+    await app.state.stocks.preload()
     yield
     await Tortoise.close_connections()
     await app.state.session.close()
@@ -28,29 +41,127 @@ async def lifespan(app: FastAPI):
 app = FastAPI(lifespan=lifespan)
 
 
+async def fetch_stock(stock_id: str) -> StockInfo | None:
+    async with (
+        app.state.upstream,
+        app.state.session.get(f"https://stock-api.seria.moe/stocks/{stock_id}") as resp,
+    ):
+        if resp.status != 200:
+            return None
+        data = await resp.json()
+    return StockInfo(id=stock_id, name=data["name"])
+
+
 @app.get("/")
 async def index() -> Response:
     return Response(status_code=200, content="News Notify API v1.0")
 
 
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(
+        content=await REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/add-stock")
 async def add_stock(user_id: str, stock_id: str) -> Response:
-    async with app.state.session.get(
-        f"https://stock-api.seria.moe/stocks/{stock_id}"
-    ) as resp:
-        if resp.status != 200:
-            raise HTTPException(status_code=404, detail="stock not found")
-        data = await resp.json()
+    stock_info = await app.state.stocks.get(stock_id)
+    if stock_info is None:
+        raise HTTPException(status_code=404, detail="stock not found")
 
-    stock_name = data["name"]
     user = await User.get_or_none(id=user_id)
     if user is None:
         raise HTTPException(status_code=404, detail="user not found")
 
-    stock, _ = await Stock.get_or_create(id=stock_id, name=stock_name)
+    stock, _ = await Stock.get_or_create(
+        id=stock_info.id, defaults={"name": stock_info.name}
+    )
     await user.stocks.add(stock)
     return Response(status_code=200, content="stock added")
 
 
+class SubscriptionStatus(StrEnum):
+    ADDED = "added"
+    ALREADY_SUBSCRIBED = "already_subscribed"
+    STOCK_NOT_FOUND = "stock_not_found"
+    # the stock API failed, the subscription can be retried
+    UPSTREAM_ERROR = "upstream_error"
+    USER_NOT_FOUND = "user_not_found"
+
+
+class SubscriptionsRequest(BaseModel):
+    user_ids: list[str] = Field(min_length=1, max_length=1000)
+    stock_ids: list[str] = Field(min_length=1, max_length=500)
+
+
+class SubscriptionResult(BaseModel):
+    user_id: str
+    stock_id: str
+    status: SubscriptionStatus
+
+
+class SubscriptionsResponse(BaseModel):
+    results: list[SubscriptionResult]
+
+
+@app.post("/subscriptions")
+async def add_subscriptions(request: SubscriptionsRequest) -> SubscriptionsResponse:
+    """Subscribe every user to every stock in one round trip."""
+    user_ids = list(dict.fromkeys(request.user_ids))
+    stock_ids = list(dict.fromkeys(stock_id.strip() for stock_id in request.stock_ids))
+
+    stock_infos = await asyncio.gather(
+        *(app.state.stocks.get(stock_id) for stock_id in stock_ids),
+        return_exceptions=True,
+    )
+    stocks: dict[str, StockInfo] = {}
+    # a failing upstream lookup only fails the subscriptions to that stock
+    upstream_errors: set[str] = set()
+    for stock_id, info in zip(stock_ids, stock_infos, strict=True):
+        if isinstance(info, aiohttp.ClientError | TimeoutError):
+            upstream_errors.add(stock_id)
+        elif isinstance(info, BaseException):
+            raise info
+        elif info is not None:
+            stocks[stock_id] = info
+    users = set(
+        cast(list[str], await User.filter(id__in=user_ids).values_list("id", flat=True))
+    )
+
+    await Stock.bulk_create(
+        [Stock(id=info.id, name=info.name) for info in stocks.values()],
+        ignore_conflicts=True,
+    )
+    added = await bulk_add_relations(
+        User,
+        "stocks",
+        [
+            (user_id, stocks[stock_id].id)
+            for user_id in users
+            for stock_id in stock_ids
+            if stock_id in stocks
+        ],
+    )
+
+    results: list[SubscriptionResult] = []
+    for user_id in user_ids:
+        for stock_id in stock_ids:
+            if user_id not in users:
+                status = SubscriptionStatus.USER_NOT_FOUND
+            elif stock_id in upstream_errors:
+                status = SubscriptionStatus.UPSTREAM_ERROR
+            elif stock_id not in stocks:
+                status = SubscriptionStatus.STOCK_NOT_FOUND
+            elif (user_id, stocks[stock_id].id) in added:
+                status = SubscriptionStatus.ADDED
+            else:
+                status = SubscriptionStatus.ALREADY_SUBSCRIBED
+            results.append(
+                SubscriptionResult(user_id=user_id, stock_id=stock_id, status=status)
+            )
+    return SubscriptionsResponse(results=results)
+
+
 if __name__ == "__main__":
     uvicorn.run("api:app", port=6072, log_level="info")
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from aiohttp import web
+from pydantic import BaseModel
+from tortoise import Tortoise, connections
+
+from news_notify.bot import NewsNotify
+from news_notify.db import init_db
+from news_notify.migrations import migrate
+from news_notify.models import (
+    BotState,
+    Delivery,
+    News,
+    Stock,
+    User,
+    bulk_add_relations,
+)
+from news_notify.stock_directory import StockDirectory, StockInfo
+from news_notify.utils import percentile
+
+
+class FakeNews(BaseModel):
+    stock_id: str
+    date_of_speech: str
+    time_of_speech: str
+    title: str
+
+
+class FakeStockCrawl:
+    """Stands in for StockCrawl, every fetch returns ``count`` new announcements."""
+
+    def __init__(self, stock_ids: list[str], count: int) -> None:
+        self.stock_ids = stock_ids
+        self.count = count
+        self._batch = 0
+
+    async def fetch_news(self) -> list[FakeNews]:
+        self._batch += 1
+        return [
+            FakeNews(
+                stock_id=random.choice(self.stock_ids),
+                date_of_speech="1140101",
+                time_of_speech=f"{self._batch:04}{i:06}",
+                title=f"benchmark announcement {self._batch}-{i}",
+            )
+            for i in range(self.count)
+        ]
+
+    async def fetch_stock(self, stock_id: str) -> StockInfo | None:
+        return StockInfo(stock_id, f"stock {stock_id}")
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeDiscord:
+    """Local webhook endpoint with a fixed latency and a share of 429 responses."""
+
+    def __init__(self, *, latency: float, rate_limited: float) -> None:
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.received: list[float] = []
+        self.rate_limited_count = 0
+        self.port = 0
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        await request.read()
+        await asyncio.sleep(self.latency)
+        if random.random() < self.rate_limited:
+            self.rate_limited_count += 1
+            return web.json_response({"retry_after": 0.05}, status=429)
+        self.received.append(time.perf_counter())
+        return web.Response(status=204)
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/api/webhooks/{id}/{token}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # type: ignore
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+@contextmanager
+def count_queries() -> Iterator[list[int]]:
+    db = connections.get("default")
+    count = [0]
+    originals = {}
+    for name in (
+        "execute_query",
+        "execute_query_dict",
+        "execute_insert",
+        "execute_many",
+    ):
+        original = originals[name] = getattr(db, name)
+
+        async def counted(*args, _original=original, **kwargs):
+            count[0] += 1
+            return await _original(*args, **kwargs)
+
+        setattr(db, name, counted)
+    try:
+        yield count
+    finally:
+        for name, original in originals.items():
+            setattr(db, name, original)
+
+
+async def seed(args: argparse.Namespace, port: int) -> list[str]:
+    stock_ids = [str(1000 + i) for i in range(args.stocks)]
+    await Stock.bulk_create(
+        [Stock(id=stock_id, name=f"stock {stock_id}") for stock_id in stock_ids],
+        ignore_conflicts=True,
+    )
+    await User.bulk_create(
+        [
+            User(
+                id=f"U{i:032}",
+                line_notify_token=f"http://127.0.0.1:{port}/api/webhooks/{i}/token",
+                digest=args.digest,
+                # given on follow in production, see NewsNotify.on_follow
+                ordinal=i + 1,
+            )
+            for i in range(args.users)
+        ],
+        batch_size=1000,
+    )
+    pairs = [
+        (f"U{i:032}", stock_id)
+        for i in range(args.users)
+        for stock_id in random.sample(stock_ids, min(args.subs, len(stock_ids)))
+    ]
+    for start in range(0, len(pairs), 5000):
+        await bulk_add_relations(User, "stocks", pairs[start : start + 5000])
+    return stock_ids
+
+
+async def run_once(args: argparse.Namespace) -> dict[str, float]:
+    random.seed(args.seed)
+    discord = FakeDiscord(latency=args.latency / 1000, rate_limited=args.rate_limited)
+    await discord.start()
+
+    await init_db(args.db_url)
+    await Tortoise.generate_schemas()
+    await migrate()
+    for model in (Delivery, News, User, Stock, BotState):
+        await model.all().delete()
+    stock_ids = await seed(args, discord.port)
+
+    bot = NewsNotify("benchmark", "benchmark", db_url=args.db_url)
+    crawl = FakeStockCrawl(stock_ids, args.news)
+    bot.crawl = crawl  # type: ignore
+    bot.stocks = StockDirectory(crawl.fetch_stock, index=bot.stock_index)
+    bot.outbox.poll_interval = 0.1
+    await bot.webhook.start()
+    # the news cursor starts empty, load_state would also start the scheduler
+    await bot.subscribers.load()
+    bot.state_loaded.set()
+
+    start = time.perf_counter()
+    with count_queries() as queries:
+        await bot.crawl_news()
+    crawl_time = time.perf_counter() - start
+    crawl_queries = queries[0]
+    deliveries = await Delivery.all().count()
+
+    bot.outbox.start()
+    while await Delivery.filter(attempts__lt=bot.outbox.max_attempts).exists():
+        await asyncio.sleep(0.05)
+    end = time.perf_counter()
+    await bot.outbox.stop()
+    await bot.webhook.close()
+    await discord.close()
+    await Tortoise.close_connections()
+
+    latencies = [received - start for received in discord.received]
+    return {
+        "users": args.users,
+        "subs": args.subs,
+        "news": args.news,
+        "deliveries": deliveries,
+        "requests": len(discord.received),
+        "rate_limited": discord.rate_limited_count,
+        "crawl_s": crawl_time,
+        "crawl_queries": crawl_queries,
+        "total_s": end - start,
+        "sends_per_s": len(discord.received) / (end - start),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+COLUMNS = (
+    "users",
+    "subs",
+    "news",
+    "deliveries",
+    "requests",
+    "rate_limited",
+    "crawl_s",
+    "crawl_queries",
+    "total_s",
+    "sends_per_s",
+    "p50_ms",
+    "p99_ms",
+    "peak_rss_mb",
+)
+
+
+def print_table(rows: list[dict[str, float]]) -> None:
+    print(" ".join(f"{column:>13}" for column in COLUMNS))
+    for row in rows:
+        print(
+            " ".join(
+                f"{row[column]:>13.2f}"
+                if isinstance(row[column], float)
+                else f"{row[column]:>13}"
+                for column in COLUMNS
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure crawl_news and outbox delivery against local stand-ins "
+        "for StockCrawl and Discord. Each scale point runs in a fresh process."
+    )
+    parser.add_argument(
+        "--scale",
+        default="100x5,1000x5,5000x10",
+        help="comma separated USERSxSUBSCRIPTIONS points",
+    )
+    parser.add_argument("--news", type=int, default=50, help="announcements per crawl")
+    parser.add_argument(
+        "--stocks", type=int, default=200, help="stocks to subscribe to"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=50, help="webhook latency in ms"
+    )
+    parser.add_argument(
+        "--rate-limited", type=float, default=0.0, help="share of 429 responses"
+    )
+    parser.add_argument("--digest", action="store_true", help="users use digest mode")
+    parser.add_argument(
+        "--db-url",
+        help="database to use, its tables are emptied, a temporary SQLite file by default",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    # internal, runs a single scale point in this process
+    parser.add_argument("--users", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--subs", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.users is not None:
+        print(json.dumps(asyncio.run(run_once(args))))
+        return
+
+    rows: list[dict[str, float]] = []
+    for point in args.scale.split(","):
+        users, subs = point.split("x")
+        with tempfile.TemporaryDirectory() as tmp:
+            db_url = args.db_url or f"sqlite://{os.path.join(tmp, 'benchmark.sqlite3')}"
+            command = [
+                sys.executable,
+                "-m",
+                "benchmarks.fanout",
+                *sys.argv[1:],
+                "--users",
+                users,
+                "--subs",
+                subs,
+                "--db-url",
+                db_url,
+            ]
+            output = subprocess.run(
+                command, check=True, capture_output=True, text=True
+            ).stdout
+        row = json.loads(output.strip().splitlines()[-1])
+        rows.append(row)
+        if args.json:
+            print(json.dumps(row))
+    if not args.json:
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
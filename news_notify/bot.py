@@ -1,128 +1,461 @@
+import asyncio
+import datetime
 import logging
 import sys
+import time
+from collections.abc import Awaitable, Callable, Coroutine
+from operator import itemgetter
 from pathlib import Path
+from typing import Any
 
+import aiohttp
+from aiohttp import web
 from line import Bot
-from linebot.v3.webhooks import FollowEvent, MessageEvent
+from line.models import TextMessage
+from linebot.v3.webhook import Event, InvalidSignatureError
+from linebot.v3.webhooks import (
+    FollowEvent,
+    MessageEvent,
+    PostbackEvent,
+    UnfollowEvent,
+)
 from stock_crawl import StockCrawl
-from tortoise import Tortoise
+from tortoise import Tortoise, connections
 from tortoise.exceptions import IntegrityError
 
-from .models import News, Stock, User
-from .rich_menus import RICH_MENU_1, RICH_MENU_2, RICH_MENU_3
-from .utils import get_now, send_webhook
+from . import notified
+from .conversations import ConversationStore, UserTempDataBackend
+from .db import init_db
+from .intake import EventQueue
+from .messages import MessageRenderer
+from .metrics import (
+    COMMAND_SECONDS,
+    COMMANDS,
+    CRAWL_PHASE_SECONDS,
+    CRAWLED_NEWS,
+    LINE_EVENT_QUEUE_DEPTH,
+    LINE_EVENTS,
+    OUTBOX_DEPTH,
+    REGISTRY,
+    instrument_queries,
+    monitor_event_loop,
+    start_metrics_server,
+)
+from .migrations import migrate
+from .models import News, Stock, User, padded_time
+from .news_cursor import NewsCursor, NewsItem
+from .outbox import Outbox
+from .responses import ResponseCache
+from .rich_menu_sync import RichMenuLinker, RichMenuSync
+from .rich_menus import RICH_MENUS
+from .scheduler import TWSE_CALENDAR, AnyOf, Cron, Interval, Schedule, Scheduler
+from .stock_directory import StockDirectory
+from .stock_index import StockIndex, fetch_stock_universe
+from .subscriptions import SubscriberIndex
+from .utils import get_now, shorten
+from .webhook import WebhookSender
 
 
 class NewsNotify(Bot):
     def __init__(
-        self, channel_secret: str, access_token: str, *, db_url: str | None = None
+        self,
+        channel_secret: str,
+        access_token: str,
+        *,
+        db_url: str | None = None,
+        read_db_url: str | None = None,
+        crawl_interval: float | None = None,
+        persist_conversations: bool = False,
+        run_outbox: bool = True,
+        queue_events: bool = False,
+        metrics_port: int | None = None,
     ) -> None:
         super().__init__(channel_secret=channel_secret, access_token=access_token)
         self.db_url = db_url
+        self.read_db_url = read_db_url
+        # when False, worker.py processes deliver what this process enqueues
+        self.run_outbox = run_outbox
+        # /metrics is served on its own port, not on the public webhook app
+        self.metrics_port = metrics_port
+        self._metrics_server: web.AppRunner | None = None
         self.crawl = StockCrawl()
+        self.webhook = WebhookSender()
+        self.renderer = MessageRenderer()
+        # rendered carousels, see news_notify/cogs/company.py
+        self.responses = ResponseCache()
+        self.outbox = Outbox(self.webhook, renderer=self.renderer)
+        # when set, webhook requests are answered right away and their events
+        # handled by these workers
+        self.events = EventQueue(self.handle_event) if queue_events else None
+        self.news_cursor = NewsCursor()
+        self.stock_index = StockIndex()
+        self.subscribers = SubscriberIndex()
+        self.conversations = ConversationStore(
+            backend=UserTempDataBackend() if persist_conversations else None
+        )
+        self.stocks = StockDirectory(self.crawl.fetch_stock, index=self.stock_index)
         self.basic_id = "847mdfxp"
         self.app_url = (
             "https://news-notify-linebot.seriaati.xyz"
             if sys.platform == "linux"
             else "https://vastly-assuring-grub.ngrok-free.app"
         )
-        self.task_interval = 1
+        # scheduled work goes through self.scheduler, run_tasks is not used
+        self.task_interval = 3600
+
+        # every 30 minutes between 6am and 11pm, plus every crawl_interval
+        # seconds while the market is open if set
+        crawl_schedule: Schedule = Cron("*/30 6-22 * * *")
+        if crawl_interval is not None:
+            crawl_schedule = AnyOf(
+                crawl_schedule, Interval(crawl_interval, calendar=TWSE_CALENDAR)
+            )
+        self.scheduler = Scheduler()
+        self.scheduler.add_job("crawl_news", self.crawl_news, crawl_schedule, jitter=5)
+        self.scheduler.add_job(
+            "refresh_stock_index", self.refresh_stock_index, Cron("0 5 * * *")
+        )
+        self.scheduler.add_job(
+            "compact_notified", self.compact_notified, Cron("0 4 * * *")
+        )
+        self.rich_menus = RichMenuSync(self)
+        self.rich_menu_linker = RichMenuLinker(self)
+        self._background_tasks: set[asyncio.Task] = set()
+        # set once the background startup phases finished, see /health
+        self.ready = asyncio.Event()
+        # set once the news cursor and the subscribers are loaded, crawls and
+        # subscriber changes wait for it so the load doesn't lose them
+        self.state_loaded = asyncio.Event()
+        self._rich_menus_ready = asyncio.Event()
+        self.startup_timings: dict[str, float] = {}
+
+    async def _handle_request(self, request: web.Request) -> web.Response:
+        if self.events is None:
+            return await super()._handle_request(request)
+        try:
+            events: list[Event] = self.webhook_parser.parse(  # type: ignore
+                await request.text(), request.headers.get("X-Line-Signature", "")
+            )
+        except InvalidSignatureError:
+            logging.error("Invalid signature")
+            return web.Response(status=400, text="Invalid signature")
+
+        queued = self.events.put(events)
+        if queued is None:
+            # LINE redelivers them later if redelivery is enabled for the channel
+            LINE_EVENTS.inc(len(events), result="rejected")
+            logging.warning(
+                "Event queue is unavailable, rejected %d events", len(events)
+            )
+            return web.Response(status=503, text="Busy")
+        new, duplicates = queued
+        LINE_EVENTS.inc(new, result="queued")
+        LINE_EVENTS.inc(duplicates, result="duplicate")
+        return web.Response(text="OK")
+
+    async def handle_event(self, event: Event) -> None:
+        handlers: dict[type[Event], Callable[[Any], Awaitable[None]]] = {
+            PostbackEvent: self.on_postback,
+            MessageEvent: self.on_message,
+            FollowEvent: self.on_follow,
+            UnfollowEvent: self.on_unfollow,
+        }
+        handler = next((h for t, h in handlers.items() if isinstance(event, t)), None)
+        if handler is None:
+            logging.error("Event type %s is not supported", type(event))
+            return
+        try:
+            await handler(event)
+        # one failing event must not take down the intake worker handling it
+        except Exception as e:  # noqa: BLE001
+            await self.on_error(e)
+
+    def run_in_background(
+        self, coro: Coroutine[Any, Any, str], *, notify: str
+    ) -> asyncio.Task:
+        """Run ``coro`` without holding up event handling, then push the text it
+        returns, or that it failed, to the ``notify`` user.
+        """
+
+        async def run() -> None:
+            try:
+                text = await coro
+            except Exception:
+                logging.exception("Background job failed")
+                text = "❌ failed, see the logs"
+            await self.push_message(notify, [TextMessage(text=shorten(text, 5000))])
+
+        return self._spawn(run())
+
+    def _spawn(self, coro: Coroutine[Any, Any, None]) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
 
     async def on_follow(self, event: FollowEvent) -> None:
         try:
-            await User.create(id=event.source.user_id)  # type: ignore
+            user = await User.create(id=event.source.user_id)  # type: ignore
         except IntegrityError:
-            pass
+            return
+        await notified.assign_ordinal(user)
 
     async def on_message(self, event: MessageEvent) -> None:
         if event.message is None:
             return
         text: str = event.message.text  # type: ignore
-        user = await User.get(id=event.source.user_id)  # type: ignore
-        if user.temp_data:
-            event.message.text = user.temp_data.format(text=text)  # type: ignore
-            user.temp_data = None
-            await user.save()
+        state = self.conversations.pop(event.source.user_id)  # type: ignore
+        if state:
+            event.message.text = state.format(text=text)  # type: ignore
 
         await super().on_message(event)
 
-    async def run_tasks(self) -> None:
-        now = get_now()
-        # run task every 30 minutes
-        if now.minute % 30 == 0 and now.second < 1:
-            await self.crawl_news()
+    async def process_command(self, text: str, user_id: str, reply_token: str) -> Any:
+        cmd = self._parse_data(text).get("cmd")
+        if not cmd or not any(cmd in cog.commands for cog in self.cogs):
+            return await super().process_command(text, user_id, reply_token)
+
+        with COMMAND_SECONDS.time(command=cmd):
+            try:
+                result = await super().process_command(text, user_id, reply_token)
+            except Exception:
+                COMMANDS.inc(command=cmd, result="error")
+                raise
+        COMMANDS.inc(command=cmd, result="ok")
+        return result
 
     async def crawl_news(self) -> None:
-        now = get_now()
-        # do not crawl news between 11pm and 6am
-        if 23 <= now.hour <= 6:
+        await self.state_loaded.wait()
+        # already processed announcements never reach the database
+        with CRAWL_PHASE_SECONDS.time(phase="fetch"):
+            # also picks up subscription changes made by the API process
+            fetched, _ = await asyncio.gather(
+                self.crawl.fetch_news(), self.subscribers.reconcile()
+            )
+            fetched_news = self.news_cursor.filter_new(fetched)
+        if not fetched_news:
             return
+        detected_at = get_now()
+        CRAWLED_NEWS.inc(len(fetched_news))
+        news = {
+            f"{n.stock_id}_{n.date_of_speech}_{n.time_of_speech}"[:100]: n
+            for n in fetched_news
+        }
+
+        with CRAWL_PHASE_SECONDS.time(phase="store"):
+            news = await self._store_news(news, detected_at)
 
-        news = await self.crawl.fetch_news()
-        for n in news:
-            db_stock = await Stock.get_or_none(id=n.stock_id)
-            if db_stock is None:
-                fetched_stock = await self.crawl.fetch_stock(n.stock_id)
-                if fetched_stock is None:
-                    continue
-                db_stock = await Stock.create(
-                    id=fetched_stock.id, name=fetched_stock.name
+        # users that were already notified are skipped by the outbox workers,
+        # and each user's deliveries are queued together so digests stay whole
+        with CRAWL_PHASE_SECONDS.time(phase="fan_out"):
+            await self.outbox.enqueue(
+                sorted(
+                    (
+                        (news_id, user_id)
+                        for news_id, n in news.items()
+                        for user_id in self.subscribers.subscribers(n.stock_id)
+                    ),
+                    key=itemgetter(1),
                 )
+            )
 
-            news_id = f"{n.stock_id}_{n.date_of_speech}_{n.time_of_speech}"[:100]
-            db_news = await News.get_or_none(id=news_id)
-            if db_news is None:
-                db_news = await News.create(
+        # news whose stock couldn't be resolved are retried by the next crawl
+        self.news_cursor.advance(list(news.values()))
+        await self.news_cursor.save()
+
+    async def _store_news(
+        self, news: dict[str, NewsItem], detected_at: datetime.datetime
+    ) -> dict[str, NewsItem]:
+        """Save new announcements, returns those whose stock is known."""
+        # resolve every stock of this batch at once, fetching only unknown ones
+        stock_ids = {n.stock_id for n in news.values()}
+        stocks = {stock.id: stock for stock in await Stock.filter(id__in=stock_ids)}
+        if missing := stock_ids - stocks.keys():
+            fetched_stocks = await asyncio.gather(
+                *(self.stocks.get(stock_id) for stock_id in missing)
+            )
+            new_stocks = [
+                Stock(id=stock.id, name=stock.name)
+                for stock in fetched_stocks
+                if stock is not None
+            ]
+            await Stock.bulk_create(new_stocks, ignore_conflicts=True)
+            stocks.update({stock.id: stock for stock in new_stocks})
+        news = {news_id: n for news_id, n in news.items() if n.stock_id in stocks}
+
+        existing_news = set(
+            await News.filter(id__in=news.keys()).values_list("id", flat=True)
+        )
+        await News.bulk_create(
+            [
+                News(
                     id=news_id,
                     data=n.model_dump_json(),
-                    stock=db_stock,
+                    date_of_speech=n.date_of_speech,
+                    time_of_speech=padded_time(n.time_of_speech),
+                    title=n.title,
+                    stock_id=n.stock_id,
+                    created_at=detected_at,
                 )
+                for news_id, n in news.items()
+                if news_id not in existing_news
+            ],
+            ignore_conflicts=True,
+        )
+        # cached pages that list news of these stocks or count them are stale
+        self.responses.invalidate(
+            *{
+                ("stock", n.stock_id)
+                for news_id, n in news.items()
+                if news_id not in existing_news
+            }
+        )
+        return news
 
-            await db_news.fetch_related("notified_users")
-            notified_users = await db_news.notified_users.all()
-            users = await User.filter(stocks__id=n.stock_id)
-            for user in users:
-                if user in notified_users:
-                    continue
-                if user.line_notify_token is None:
-                    continue
-
-                await send_webhook(
-                    f"{db_stock}\n{db_news}\nhttps://goodinfo.tw/tw/StockDetail.asp?STOCK_ID={n.stock_id}",
-                    url=user.line_notify_token,
-                )
-                await db_news.notified_users.add(user)
+    async def refresh_stock_index(self) -> None:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as session:
+            stocks = await fetch_stock_universe(session)
+        self.stock_index.update(stocks)
+        logging.info("Stock index has %d companies", len(self.stock_index))
 
-    async def setup_hook(self) -> None:
-        logging.info("Setting up database")
-        await Tortoise.init(
-            db_url=self.db_url or "sqlite://db.sqlite3",
-            modules={"models": ["news_notify.models"]},
-        )
+    async def compact_notified(self) -> None:
+        await notified.compact(notified.RETENTION)
+
+    async def link_rich_menu(self, name: str, user_ids: list[str]) -> None:
+        await self._rich_menus_ready.wait()
+        rich_menu_id = self.rich_menus.ids.get(name)
+        if rich_menu_id is None:
+            logging.error("Rich menu %s is not set up, not linking it", name)
+            return
+        await self.link_rich_menu_to_users(rich_menu_id, user_ids)
+
+    async def setup_rich_menus(self) -> None:
+        try:
+            await self.rich_menus.sync(RICH_MENUS)
+        finally:
+            self._rich_menus_ready.set()
+        if "rich_menu_2" in self.rich_menus.changed:
+            await self.line_bot_api.set_default_rich_menu(
+                self.rich_menus.ids["rich_menu_2"]
+            )
+        # users stay linked to menus that were reused, only a recreated menu
+        # needs its users moved over
+        if self.rich_menus.changed & {"rich_menu_1", "rich_menu_3"}:
+            linked = await self.rich_menu_linker.link(
+                self.rich_menus.ids["rich_menu_1"]
+            )
+        else:
+            linked = await self.rich_menu_linker.resume()
+        # users that are not linked yet still use the replaced menus
+        if linked:
+            await self.rich_menus.delete_stale()
+
+    async def load_state(self) -> None:
+        # crawls need the cursor and the subscribers, so loading them is retried
+        # until it works instead of leaving the bot without scheduled jobs
+        delay = 1
+        while True:
+            try:
+                await asyncio.gather(self.news_cursor.load(), self.subscribers.load())
+                break
+            except Exception:
+                logging.exception("Failed to load state, retrying in %ds", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        self.state_loaded.set()
+        self.scheduler.start()
+
+    async def warm_stock_caches(self) -> None:
+        await self.stocks.preload()
+        await self.refresh_stock_index()
+
+    async def setup_database(self) -> None:
+        await init_db(self.db_url, read_url=self.read_db_url)
+        instrument_queries(connections.get("default"))
         await Tortoise.generate_schemas()
+        await migrate()
 
-        logging.info("Loading cogs")
+    async def collect_metrics(self) -> None:
+        for status, count in (await self.outbox.depth()).items():
+            OUTBOX_DEPTH.set(count, status=status.name.lower())
+        if self.events is not None:
+            LINE_EVENT_QUEUE_DEPTH.set(len(self.events))
+
+    def load_cogs(self) -> None:
         for cog in Path("news_notify/cogs").glob("*.py"):
             logging.info("Loading cog %s", cog.stem)
             self.add_cog(f"news_notify.cogs.{cog.stem}")
 
-        logging.info("Setting up rich menus")
-        await self.delete_all_rich_menus()
-        self.rich_menu_1_id = await self.create_rich_menu(
-            RICH_MENU_1, "assets/rich_menu_1.png"
-        )
-        self.rich_menu_2_id = await self.create_rich_menu(
-            RICH_MENU_2, "assets/rich_menu_2.png"
-        )
-        await self.line_bot_api.set_default_rich_menu(self.rich_menu_2_id)
-        self.rich_menu_3_id = await self.create_rich_menu(
-            RICH_MENU_3, "assets/rich_menu_3.png"
+    async def _run_phase(self, name: str, phase: Awaitable[None]) -> None:
+        start = time.perf_counter()
+        try:
+            await phase
+        finally:
+            self.startup_timings[name] = time.perf_counter() - start
+            logging.info(
+                "Startup phase %s took %.2fs", name, self.startup_timings[name]
+            )
+
+    async def _warm_up(self) -> None:
+        phases = {
+            "state": self.load_state(),
+            "stock_caches": self.warm_stock_caches(),
+            "rich_menus": self.setup_rich_menus(),
+        }
+        results = await asyncio.gather(
+            *(self._run_phase(name, phase) for name, phase in phases.items()),
+            return_exceptions=True,
         )
-        users = await User.all()
-        linked = [user.id for user in users if user.line_notify_token]
-        if linked:
-            await self.link_rich_menu_to_users(self.rich_menu_1_id, linked)
+        failed = []
+        for name, result in zip(phases, results, strict=True):
+            if isinstance(result, Exception):
+                logging.error("Startup phase %s failed", name, exc_info=result)
+                failed.append(name)
+        self.ready.set()
+        if failed:
+            logging.warning("Bot is ready without %s", ", ".join(failed))
+        else:
+            logging.info("Bot is ready")
+
+    async def handle_health(self, _: web.Request) -> web.Response:
+        if not self.ready.is_set():
+            return web.Response(status=503, text="starting")
+        return web.Response(text="ok")
+
+    async def setup_hook(self) -> None:
+        # only what handling an event needs runs before the server starts,
+        # the rest warms up in the background
+        start = time.perf_counter()
+        await self._run_phase("webhook", self.webhook.start())
+        await self._run_phase("database", self.setup_database())
+        await self._run_phase("conversations", self.conversations.start())
+        if self.run_outbox:
+            self.outbox.start()
+        self.load_cogs()
+        REGISTRY.add_collector(self.collect_metrics)
+        if self.metrics_port is not None:
+            self._metrics_server = await start_metrics_server(self.metrics_port)
+        self.app.router.add_get("/health", self.handle_health)
+
+        if self.events is not None:
+            self.events.start()
+        self._spawn(self._warm_up())
+        self._spawn(monitor_event_loop())
+        logging.info("Serving events after %.2fs", time.perf_counter() - start)
 
     async def on_close(self) -> None:
+        # handle the queued events while the rest of the bot is still up
+        if self.events is not None:
+            await self.events.stop()
+        for task in [*self._background_tasks]:
+            task.cancel()
+        if self._metrics_server is not None:
+            await self._metrics_server.cleanup()
+        await self.scheduler.stop()
+        await self.outbox.stop()
+        await self.conversations.stop()
         await Tortoise.close_connections()
         await self.crawl.close()
+        await self.webhook.close()
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+
+
+class TTLCache[K: Hashable, V]:
+    """A least-recently-used cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        if maxsize <= 0:
+            msg = "Parameter maxsize must be a positive integer"
+            raise ValueError(msg)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, *, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else float("inf")
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> V | None:
+        item = self._data.pop(key, None)
+        return None if item is None else item[1]
+
+    def expire(self) -> list[K]:
+        """Drop expired entries and return their keys."""
+        now = time.monotonic()
+        expired = [
+            key for key, (expires_at, _) in self._data.items() if expires_at < now
+        ]
+        for key in expired:
+            del self._data[key]
+        return expired
+
+    def clear(self) -> None:
+        self._data.clear()
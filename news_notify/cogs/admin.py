@@ -1,7 +1,14 @@
+import datetime
+import time
+
 from line import Cog, Context, command
 from line.models import PostbackAction, QuickReply, QuickReplyItem
 
+from .. import latency
 from ..bot import NewsNotify
+from ..db import pool_stats
+from ..models import DeliveryStatus
+from ..utils import shorten
 
 OWNER_ID = "Udfc687303c03a91398d74cbfd33dcea4"
 
@@ -22,6 +29,18 @@ class AdminCog(Cog):
                     data="cmd=crawl_news",
                 ),
             ),
+            QuickReplyItem(
+                action=PostbackAction(
+                    label="db pool stats",
+                    data="cmd=db_pool_stats",
+                ),
+            ),
+            QuickReplyItem(
+                action=PostbackAction(
+                    label="latency report",
+                    data="cmd=latency_report",
+                ),
+            ),
         ]
         await ctx.reply_text("管理員界面", quick_reply=QuickReply(items=items))
 
@@ -30,7 +49,39 @@ class AdminCog(Cog):
         if ctx.user_id != OWNER_ID:
             return
         await ctx.reply_text("crawling news...")
+        self.bot.run_in_background(self._crawl_news(), notify=ctx.user_id)
+
+    async def _crawl_news(self) -> str:
+        start = time.perf_counter()
         await self.bot.crawl_news()
+        pending = (await self.bot.outbox.depth())[DeliveryStatus.PENDING]
+        return (
+            f"crawled news in {time.perf_counter() - start:.1f}s, "
+            f"{pending} deliveries pending"
+        )
+
+    @command
+    async def db_pool_stats(self, ctx: Context) -> None:
+        if ctx.user_id != OWNER_ID:
+            return
+        if not pool_stats:
+            await ctx.reply_text("no connection pool in use")
+            return
+        lines = [
+            f"{name}: {stats.acquired} acquires, "
+            f"avg {stats.total_wait / max(stats.acquired, 1) * 1000:.1f}ms, "
+            f"p95 {stats.percentile(0.95) * 1000:.1f}ms, "
+            f"max {stats.max_wait * 1000:.1f}ms"
+            for name, stats in pool_stats.items()
+        ]
+        await ctx.reply_text("\n".join(lines))
+
+    @command
+    async def latency_report(self, ctx: Context, hours: int = 24) -> None:
+        if ctx.user_id != OWNER_ID:
+            return
+        report = await latency.report(datetime.timedelta(hours=hours))
+        await ctx.reply_text(shorten(report, 5000))
 
     @command
     async def get_user_id(self, ctx: Context) -> None:
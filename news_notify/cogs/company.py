@@ -8,10 +8,18 @@ from line.models import (
     QuickReply,
     QuickReplyItem,
 )
+from tortoise.functions import Count
 
 from ..bot import NewsNotify
+from ..db import read_db
 from ..models import News, Stock, User
-from ..utils import shorten, split_list
+from ..responses import TemplateReply
+from ..utils import shorten
+
+# a carousel holds at most 10 columns
+PAGE_SIZE = 10
+# the API process changes subscriptions without invalidating this process' cache
+SUBSCRIPTIONS_TTL = 60
 
 
 class StockCog(Cog):
@@ -23,11 +31,10 @@ class StockCog(Cog):
     async def add_company(
         self, ctx: Context, stock_id_or_name: str | None = None
     ) -> Any:
-        user = await User.get(id=ctx.user_id).prefetch_related("stocks")
-
         if stock_id_or_name is None:
-            user.temp_data = "cmd=add_company&stock_id_or_name={text}"
-            await user.save()
+            self.bot.conversations.set(
+                ctx.user_id, "cmd=add_company&stock_id_or_name={text}"
+            )
             await ctx.reply_text(
                 "請輸入欲新增的公司的股票代號或公司簡稱\n例如: 「2330」或「台積電」",
                 quick_reply=QuickReply(
@@ -39,12 +46,29 @@ class StockCog(Cog):
                 ),
             )
         else:
-            stock = await self.bot.crawl.fetch_stock(stock_id_or_name)
+            stock = self.bot.stock_index.get(
+                stock_id_or_name
+            ) or await self.bot.stocks.get(stock_id_or_name)
             if stock is None:
+                suggestions = self.bot.stock_index.search(stock_id_or_name, limit=5)
+                text = f"❌ 錯誤\n找不到簡稱或代號為「{stock_id_or_name}」的股票"
+                if suggestions:
+                    text += "\n\n您要找的是不是:\n" + "\n".join(
+                        str(suggestion) for suggestion in suggestions
+                    )
                 return await ctx.reply_text(
-                    f"❌ 錯誤\n找不到簡稱或代號為「{stock_id_or_name}」的股票",
+                    text,
                     quick_reply=QuickReply(
                         [
+                            *(
+                                QuickReplyItem(
+                                    action=PostbackAction(
+                                        label=shorten(str(suggestion), 20),
+                                        data=f"cmd=add_company&stock_id_or_name={suggestion.id}",
+                                    )
+                                )
+                                for suggestion in suggestions
+                            ),
                             QuickReplyItem(
                                 action=PostbackAction(
                                     label="🔄️ 重新輸入",
@@ -58,8 +82,14 @@ class StockCog(Cog):
                         ]
                     ),
                 )
-            db_stock, _ = await Stock.get_or_create(id=stock.id, name=stock.name)
+            user = await User.get(id=ctx.user_id)
+            db_stock, _ = await Stock.get_or_create(
+                id=stock.id, defaults={"name": stock.name}
+            )
             await db_stock.users.add(user)
+            await self.bot.state_loaded.wait()
+            self.bot.subscribers.subscribe(user.id, db_stock.id)
+            self.bot.responses.invalidate(("user", user.id))
             await ctx.reply_text(
                 f"✅ 成功\n已新增 {db_stock}, 您將會開始收到來自 {db_stock} 的重大訊息通知",
                 quick_reply=QuickReply(
@@ -81,6 +111,7 @@ class StockCog(Cog):
 
     @command
     async def cancel(self, ctx: Context) -> Any:
+        self.bot.conversations.pop(ctx.user_id)
         await ctx.reply_text(
             "已取消",
             quick_reply=QuickReply(
@@ -94,9 +125,9 @@ class StockCog(Cog):
 
     @command
     async def search_company(self, ctx: Context) -> Any:
-        user = await User.get(id=ctx.user_id)
-        user.temp_data = "cmd=view_companies&stock_id_or_name={text}"
-        await user.save()
+        self.bot.conversations.set(
+            ctx.user_id, "cmd=view_companies&stock_id_or_name={text}"
+        )
         await ctx.reply_text(
             "請輸入欲查詢的公司的股票代號或簡稱\n例如:「2330」或「台積電」",
             quick_reply=QuickReply(
@@ -108,36 +139,74 @@ class StockCog(Cog):
     async def view_companies(
         self, ctx: Context, index: int = 0, stock_id_or_name: str | None = None
     ) -> Any:
-        user = await User.get(id=ctx.user_id).prefetch_related("stocks")
-        stocks = await user.stocks.all().prefetch_related("news")
+        key = ("view_companies", ctx.user_id, index, stock_id_or_name)
+        reply = self.bot.responses.get(key)
+        if reply is None:
+            since = self.bot.responses.snapshot()
+            page = await self._companies_page(ctx.user_id, index, stock_id_or_name)
+            if page is None:
+                return await ctx.reply_text(
+                    "目前還沒有新增任何公司",
+                    quick_reply=QuickReply(
+                        [
+                            QuickReplyItem(
+                                PostbackAction(
+                                    label="➕ 新增公司",
+                                    data="cmd=add_company",
+                                    input_option="openKeyboard",
+                                )
+                            )
+                        ]
+                    ),
+                )
+            reply, stock_ids = page
+            # news counts change with crawls, subscriptions may also be changed
+            # by the API process
+            self.bot.responses.set(
+                key,
+                reply,
+                tags=[("user", ctx.user_id), *(("stock", s) for s in stock_ids)],
+                since=since,
+                ttl=SUBSCRIPTIONS_TTL,
+            )
+        await reply.send(ctx)
+        return None
 
+    async def _companies_page(
+        self, user_id: str, index: int, stock_id_or_name: str | None
+    ) -> tuple[TemplateReply, list[str]] | None:
+        query = Stock.filter(users__id=user_id)
         if stock_id_or_name:
-            stocks = [
-                stock
-                for stock in stocks
-                if stock_id_or_name in stock.id or stock_id_or_name in stock.name
-            ]
-
-        if not stocks:
-            return await ctx.reply_text(
-                "目前還沒有新增任何公司",
-                quick_reply=QuickReply(
-                    [
-                        QuickReplyItem(
-                            PostbackAction(
-                                label="➕ 新增公司",
-                                data="cmd=add_company",
-                                input_option="openKeyboard",
-                            )
-                        )
-                    ]
-                ),
+            query = query.filter(
+                id__in=[
+                    stock.id
+                    for stock in self.bot.stock_index.search(
+                        stock_id_or_name, limit=None
+                    )
+                ]
             )
+        # one extra row tells whether there is a next page
+        stocks = (
+            await query.order_by("id")
+            .offset(index * PAGE_SIZE)
+            .limit(PAGE_SIZE + 1)
+            .using_db(read_db())
+        )
+        has_next_page = len(stocks) > PAGE_SIZE
+        stocks = stocks[:PAGE_SIZE]
+        if not stocks:
+            return None
 
-        split_stocks = split_list(stocks, 10)
+        news_counts: dict[str, int] = dict(
+            await News.filter(stock_id__in=[stock.id for stock in stocks])
+            .annotate(count=Count("id"))
+            .group_by("stock_id")
+            .using_db(read_db())
+            .values_list("stock_id", "count")
+        )
         columns: list[CarouselColumn] = []
-        for stock in split_stocks[index]:
-            news_count = await stock.news.all().count()
+        for stock in stocks:
+            news_count = news_counts.get(stock.id, 0)
             column = CarouselColumn(
                 title=str(stock),
                 text=f"目前已推播過 {news_count} 則重大訊息",
@@ -161,7 +230,7 @@ class StockCog(Cog):
                     )
                 ),
             )
-        if index < len(split_stocks) - 1:
+        if has_next_page:
             quick_reply_items.append(
                 QuickReplyItem(
                     action=PostbackAction(
@@ -180,20 +249,23 @@ class StockCog(Cog):
             )
         )
 
-        await ctx.reply_template(
+        reply = TemplateReply(
             "管理公司",
             template=CarouselTemplate(columns=columns),
             quick_reply=QuickReply(items=quick_reply_items)
             if quick_reply_items
             else None,
         )
-        return None
+        return reply, [stock.id for stock in stocks]
 
     @command
     async def delete_company(self, ctx: Context, stock_id: str) -> Any:
         user = await User.get(id=ctx.user_id)
         stock = await Stock.get(id=stock_id)
         await user.stocks.remove(stock)
+        await self.bot.state_loaded.wait()
+        self.bot.subscribers.unsubscribe(user.id, stock.id)
+        self.bot.responses.invalidate(("user", user.id))
         await ctx.reply_text(
             f"✖️ 已取消追蹤 {stock}, 您將不會再收到來自 {stock} 的重大訊息通知",
             quick_reply=QuickReply(
@@ -214,28 +286,53 @@ class StockCog(Cog):
 
     @command
     async def view_news(self, ctx: Context, stock_id: str, index: int = 0) -> Any:
-        stock = await Stock.get(id=stock_id).prefetch_related("news")
-        news = await stock.news.all()
+        # not per user, every subscriber of the stock pages through the same news
+        key = ("view_news", stock_id, index)
+        reply = self.bot.responses.get(key)
+        if reply is None:
+            since = self.bot.responses.snapshot()
+            reply = await self._news_page(stock_id, index)
+            if reply is None:
+                return await ctx.reply_text(
+                    "目前還沒有推播過任何此公司的重大訊息",
+                    quick_reply=QuickReply(
+                        [
+                            QuickReplyItem(
+                                PostbackAction(
+                                    label="↩️ 返回", data="cmd=view_companies"
+                                )
+                            )
+                        ]
+                    ),
+                )
+            self.bot.responses.set(key, reply, tags=[("stock", stock_id)], since=since)
+        await reply.send(ctx)
+        return None
+
+    @staticmethod
+    async def _news_page(stock_id: str, index: int) -> TemplateReply | None:
+        stock = await Stock.get(id=stock_id)
+        news = (
+            await News.filter(stock_id=stock_id)
+            .order_by("date_of_speech", "time_of_speech")
+            .offset(index * PAGE_SIZE)
+            .limit(PAGE_SIZE + 1)
+            .using_db(read_db())
+            .values_list("id", "title")
+        )
+        has_next_page = len(news) > PAGE_SIZE
+        news = news[:PAGE_SIZE]
         if not news:
-            return await ctx.reply_text(
-                "目前還沒有推播過任何此公司的重大訊息",
-                quick_reply=QuickReply(
-                    [
-                        QuickReplyItem(
-                            PostbackAction(label="↩️ 返回", data="cmd=view_companies")
-                        )
-                    ]
-                ),
-            )
+            return None
 
-        split_news = split_list(news, 10)
         columns: list[CarouselColumn] = []
-        for news in split_news[index]:
+        for news_id, title in news:
             column = CarouselColumn(
-                text=shorten(news.data["title"]),
+                text=shorten(title),
                 actions=[
                     PostbackAction(
-                        "查看詳情", data=f"cmd=show_news_detail&news_id={news.id}&stock_id={stock_id}"
+                        "查看詳情",
+                        data=f"cmd=show_news_detail&news_id={news_id}&stock_id={stock_id}",
                     ),
                 ],
             )
@@ -251,7 +348,7 @@ class StockCog(Cog):
                     )
                 ),
             )
-        if index < len(split_news) - 1:
+        if has_next_page:
             quick_reply_items.append(
                 QuickReplyItem(
                     action=PostbackAction(
@@ -261,17 +358,18 @@ class StockCog(Cog):
                 )
             )
 
-        await ctx.reply_template(
+        return TemplateReply(
             f"{stock} 發布過的重大訊息",
             template=CarouselTemplate(columns=columns),
             quick_reply=QuickReply(items=quick_reply_items)
             if quick_reply_items
             else None,
         )
-        return None
 
     @command
     async def show_news_detail(self, ctx: Context, news_id: str, stock_id: str) -> None:
-        news = await News.get(id=news_id)
-        text = f"{news}\n\nhttps://goodinfo.tw/tw/StockDetail.asp?STOCK_ID={stock_id}"
-        await ctx.reply_text(text)
+        rendered = self.bot.renderer.get(news_id)
+        if rendered is None:
+            news = await News.get(id=news_id, stock_id=stock_id).select_related("stock")
+            rendered = self.bot.renderer.render(news)
+        await ctx.reply_text(rendered.text)
@@ -7,8 +7,6 @@ from line.models import (
     PostbackAction,
 )
 
-from news_notify.utils import send_webhook
-
 from ..bot import NewsNotify
 from ..models import User
 
@@ -30,7 +28,7 @@ class SetNotifyCog(Cog):
 
     @command
     async def continue_bot(self, ctx: Context) -> Any:
-        await self.bot.link_rich_menu_to_users(self.bot.rich_menu_1_id, [ctx.user_id])
+        await self.bot.link_rich_menu("rich_menu_1", [ctx.user_id])
         await ctx.reply_text(
             "✅ Discord Webhook 設定成功，點擊「新增公司」即可開始追蹤上市櫃公司，並在它們發布重大訊息時即時收到通知"
         )
@@ -39,8 +37,7 @@ class SetNotifyCog(Cog):
     async def set_line_notify(self, ctx: Context) -> Any:
         user = await User.get(id=ctx.user_id)
         if not user.line_notify_token:
-            user.temp_data = "cmd=set_webhook_url&url={text}"
-            await user.save()
+            self.bot.conversations.set(ctx.user_id, "cmd=set_webhook_url&url={text}")
             await ctx.reply_template(
                 "設置 Discord Webhook",
                 template=ButtonsTemplate(
@@ -54,9 +51,13 @@ class SetNotifyCog(Cog):
             )
         else:
             template = ButtonsTemplate(
-                "✅ 已完成設定",
+                "✅ 已完成設定\n摘要模式會將同時發布的多則重大訊息合併為一則推播",
                 [
                     PostbackAction("發送測試訊息", data="cmd=send_test_message"),
+                    PostbackAction(
+                        "關閉摘要模式" if user.digest else "開啟摘要模式",
+                        data="cmd=toggle_digest",
+                    ),
                     PostbackAction("解除綁定", data="cmd=reset_line_notify"),
                 ],
                 title="推播設定",
@@ -68,7 +69,9 @@ class SetNotifyCog(Cog):
         user = await User.get(id=ctx.user_id)
         user.line_notify_token = url
         await user.save()
-        await self.bot.link_rich_menu_to_users(self.bot.rich_menu_3_id, [user.id])
+        await self.bot.state_loaded.wait()
+        self.bot.subscribers.set_webhook(user.id, url)
+        await self.bot.link_rich_menu("rich_menu_3", [user.id])
         return await ctx.reply_text("✅ Discord Webhook 設定成功")
 
     @command
@@ -76,8 +79,25 @@ class SetNotifyCog(Cog):
         user = await User.get(id=ctx.user_id)
         assert user.line_notify_token
 
-        await send_webhook("這是一則測試訊息", url=user.line_notify_token)
-        await ctx.reply_text("✅ 已發送測試訊息")
+        result = await self.bot.webhook.send(
+            "這是一則測試訊息", url=user.line_notify_token
+        )
+        if not result.ok:
+            return await ctx.reply_text(
+                f"❌ 錯誤\n測試訊息發送失敗, 請確認 Discord Webhook 連結是否正確 ({result.status})"
+            )
+        return await ctx.reply_text("✅ 已發送測試訊息")
+
+    @command
+    async def toggle_digest(self, ctx: Context) -> Any:
+        user = await User.get(id=ctx.user_id)
+        user.digest = not user.digest
+        await user.save(update_fields=["digest"])
+        if user.digest:
+            return await ctx.reply_text(
+                "✅ 已開啟摘要模式, 同時發布的多則重大訊息將合併為一則推播"
+            )
+        return await ctx.reply_text("✅ 已關閉摘要模式, 每則重大訊息將分別推播")
 
     @command
     async def reset_line_notify(self, ctx: Context) -> Any:
@@ -96,7 +116,9 @@ class SetNotifyCog(Cog):
         user.line_notify_token = None
         user.line_notify_state = None
         await user.save()
-        await self.bot.link_rich_menu_to_users(self.bot.rich_menu_2_id, [user.id])
+        await self.bot.state_loaded.wait()
+        self.bot.subscribers.set_webhook(user.id, None)
+        await self.bot.link_rich_menu("rich_menu_2", [user.id])
         return await ctx.reply_text("✅ 已解除綁定 Discord Webhook")
 
     @command
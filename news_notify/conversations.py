@@ -0,0 +1,108 @@
+import asyncio
+import contextlib
+import logging
+from collections.abc import Mapping
+from typing import Protocol
+
+from .cache import TTLCache
+from .models import User
+
+
+class ConversationBackend(Protocol):
+    async def load(self) -> dict[str, str]: ...
+
+    async def save(self, states: Mapping[str, str | None]) -> None: ...
+
+
+class UserTempDataBackend:
+    """Persists conversation state in ``User.temp_data``."""
+
+    async def load(self) -> dict[str, str]:
+        return dict(
+            await User.filter(temp_data__isnull=False).values_list("id", "temp_data")
+        )
+
+    async def save(self, states: Mapping[str, str | None]) -> None:
+        await User.bulk_update(
+            [User(id=user_id, temp_data=state) for user_id, state in states.items()],
+            fields=["temp_data"],
+        )
+
+
+class ConversationStore:
+    """Pending multi-step command of each user, e.g. ``cmd=add_company&stock_id_or_name={text}``.
+
+    State lives in memory and expires after ``ttl`` seconds. With a backend,
+    changes are written behind every ``flush_interval`` seconds in one batch, so
+    handling a message never waits on the database.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: float = 10 * 60,
+        maxsize: int = 100_000,
+        backend: ConversationBackend | None = None,
+        flush_interval: float = 5,
+    ) -> None:
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._states: TTLCache[str, str] = TTLCache(maxsize, ttl)
+        self._dirty: dict[str, str | None] = {}
+        self._task: asyncio.Task | None = None
+
+    def get(self, user_id: str) -> str | None:
+        return self._states.get(user_id)
+
+    def set(self, user_id: str, state: str) -> None:
+        self._states.set(user_id, state)
+        self._mark_dirty(user_id, state)
+
+    def pop(self, user_id: str) -> str | None:
+        state = self._states.pop(user_id)
+        if state is not None:
+            self._mark_dirty(user_id, None)
+        return state
+
+    def _mark_dirty(self, user_id: str, state: str | None) -> None:
+        if self.backend is not None:
+            self._dirty[user_id] = state
+
+    async def start(self) -> None:
+        if self.backend is None:
+            return
+        for user_id, state in (await self.backend.load()).items():
+            self._states.set(user_id, state)
+        self._task = asyncio.create_task(self._flush_loop(), name="conversations-flush")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        if self.backend is None:
+            return
+        for user_id in self._states.expire():
+            self._dirty[user_id] = None
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await self.backend.save(dirty)
+        except Exception:
+            # keep newer changes made while saving
+            self._dirty = dirty | self._dirty
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Failed to persist conversation state")
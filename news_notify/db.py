@@ -0,0 +1,109 @@
+import time
+from collections import deque
+from typing import Any
+
+import asyncpg
+from asyncpg.pool import PoolConnectionProxy
+from tortoise import Tortoise, connections
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.backends.base.config_generator import expand_db_url
+
+from .utils import percentile
+
+# Postgres pool defaults, each can be overridden by the query string of the URL,
+# e.g. postgres://...?maxsize=50&statement_cache_size=0 (0 for pgbouncer)
+POOL_DEFAULTS = {
+    "minsize": 2,
+    "maxsize": 20,
+    # prepared statements kept per connection
+    "statement_cache_size": 1024,
+    "max_cached_statement_lifetime": 3600,
+}
+
+
+class PoolStats:
+    """How long queries waited for a pooled connection."""
+
+    def __init__(self, *, window: int = 1000) -> None:
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent: deque[float] = deque(maxlen=window)
+
+    def record(self, wait: float) -> None:
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._recent.append(wait)
+
+    def percentile(self, q: float) -> float:
+        return percentile(self._recent, q)
+
+
+# connection name -> its pool stats
+pool_stats: dict[str, PoolStats] = {}
+
+
+class _TimedPool:
+    def __init__(self, pool: asyncpg.Pool, stats: PoolStats) -> None:
+        self._pool = pool
+        self._stats = stats
+
+    async def acquire(self) -> PoolConnectionProxy:
+        start = time.perf_counter()
+        connection = await self._pool.acquire()
+        self._stats.record(time.perf_counter() - start)
+        return connection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._pool, name)
+
+
+class TimedAsyncpgDBClient(AsyncpgDBClient):
+    async def create_pool(self, **kwargs: Any) -> asyncpg.Pool:
+        stats = pool_stats.setdefault(self.connection_name, PoolStats())
+        return _TimedPool(await super().create_pool(**kwargs), stats)  # type: ignore
+
+
+# lets this module be used as a Tortoise engine
+client_class = TimedAsyncpgDBClient
+
+
+def _connection_config(db_url: str) -> dict[str, Any]:
+    config = expand_db_url(db_url)
+    if config["engine"] == "tortoise.backends.asyncpg":
+        config["engine"] = __name__
+        credentials = config["credentials"]
+        for key, default in POOL_DEFAULTS.items():
+            credentials[key] = int(credentials.get(key, default))
+    return config
+
+
+def tortoise_config(db_url: str | None, *, read_url: str | None = None) -> dict:
+    db_connections = {"default": _connection_config(db_url or "sqlite://db.sqlite3")}
+    if read_url:
+        db_connections["read"] = _connection_config(read_url)
+    return {
+        "connections": db_connections,
+        "apps": {
+            "models": {
+                "models": ["news_notify.models"],
+                "default_connection": "default",
+            }
+        },
+    }
+
+
+async def init_db(db_url: str | None, *, read_url: str | None = None) -> None:
+    await Tortoise.init(config=tortoise_config(db_url, read_url=read_url))
+
+
+def read_db() -> BaseDBAsyncClient:
+    """The read replica for heavy reads, or the primary if there is none.
+
+    Only for reads that can be a little behind, never inside a transaction.
+    """
+    if "read" in connections.db_config:
+        return connections.get("read")
+    return connections.get("default")
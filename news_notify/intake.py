@@ -0,0 +1,100 @@
+import asyncio
+import contextlib
+import logging
+import zlib
+from collections import Counter
+from collections.abc import Awaitable, Callable, Sequence
+
+from linebot.v3.webhook import Event
+
+from .cache import TTLCache
+
+
+def _source_id(event: Event) -> str:
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        if source_id := getattr(source, attr, None):
+            return source_id
+    return ""
+
+
+class EventQueue:
+    """Handles LINE events outside of the webhook request.
+
+    Events are spread over ``workers`` lanes by user and each lane handles its
+    events one at a time, so the events of a user keep their order while
+    different users are handled concurrently. At most ``maxsize`` events wait
+    per lane. Events that were already accepted, e.g. redelivered by LINE after a
+    slow or failed response, are dropped. Once stopping, no events are accepted
+    and the queued ones are handled for up to ``timeout`` seconds.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Event], Awaitable[None]],
+        *,
+        workers: int = 16,
+        maxsize: int = 100,
+        seen_size: int = 10000,
+        seen_ttl: float = 3600,
+    ) -> None:
+        self.handler = handler
+        self.maxsize = maxsize
+        self._lanes = [asyncio.Queue[Event](maxsize) for _ in range(workers)]
+        # webhook event ID -> accepted
+        self._seen = TTLCache[str, bool](seen_size, seen_ttl)
+        self._tasks: list[asyncio.Task] = []
+        self._closed = False
+
+    def __len__(self) -> int:
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._work(lane), name=f"event-worker-{i}")
+            for i, lane in enumerate(self._lanes)
+        ]
+
+    async def stop(self, timeout: float = 10) -> None:
+        self._closed = True
+        if self._tasks:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(lane.join() for lane in self._lanes)), timeout
+                )
+            except TimeoutError:
+                logging.warning("Dropped %d queued events on shutdown", len(self))
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks.clear()
+
+    def put(self, events: Sequence[Event]) -> tuple[int, int] | None:
+        """Queue ``events`` without waiting, all or none of them.
+
+        Returns how many were queued and how many were duplicates, or None if
+        there is no room for them or the queue is stopping.
+        """
+        if self._closed:
+            return None
+        new = [e for e in events if e.webhook_event_id not in self._seen]
+        lanes = [zlib.crc32(_source_id(e).encode()) % len(self._lanes) for e in new]
+        for lane, count in Counter(lanes).items():
+            if self._lanes[lane].qsize() + count > self.maxsize:
+                return None
+        for event, lane in zip(new, lanes, strict=True):
+            self._lanes[lane].put_nowait(event)
+            self._seen.set(event.webhook_event_id, True)
+        return len(new), len(events) - len(new)
+
+    async def _work(self, lane: asyncio.Queue[Event]) -> None:
+        while True:
+            event = await lane.get()
+            try:
+                await self.handler(event)
+            except Exception:
+                logging.exception("Failed to handle %s", type(event).__name__)
+            finally:
+                lane.task_done()
@@ -0,0 +1,150 @@
+import datetime
+import struct
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from .db import read_db
+from .models import News
+from .utils import TAIPEI, get_now, percentile
+
+# News.delivery_times holds a record per delivered user: its ordinal and when the
+# delivery was enqueued, first sent and acknowledged by the webhook, as
+# little-endian uint32 milliseconds after News.created_at, when a crawl detected
+# the news. 16 bytes per delivery, kept as long as News.notified.
+RECORD = struct.Struct("<4I")
+_MAX_MS = 2**32 - 1
+
+
+class DeliveryTiming(NamedTuple):
+    ordinal: int
+    # seconds after the news was detected
+    enqueued: float
+    sent: float
+    acked: float
+
+
+def _ms(seconds: float) -> int:
+    return min(max(round(seconds * 1000), 0), _MAX_MS)
+
+
+def encode(timings: Iterable[DeliveryTiming]) -> bytes:
+    return b"".join(
+        RECORD.pack(t.ordinal, _ms(t.enqueued), _ms(t.sent), _ms(t.acked))
+        for t in timings
+    )
+
+
+def decode(data: bytes | None) -> list[DeliveryTiming]:
+    if not data:
+        return []
+    return [
+        DeliveryTiming(ordinal, enqueued / 1000, sent / 1000, acked / 1000)
+        for ordinal, enqueued, sent, acked in RECORD.iter_unpack(data)
+    ]
+
+
+def published_at(date_of_speech: str, time_of_speech: str) -> datetime.datetime | None:
+    """When an announcement was published, from its ROC (1140102) or Gregorian
+    date and HHMMSS time. None if they can't be parsed.
+    """
+    date = date_of_speech.replace("/", "").replace("-", "")
+    time = time_of_speech.replace(":", "").zfill(6)
+    if not (date.isdigit() and len(date) in (6, 7, 8) and time.isdigit()):
+        return None
+    if len(date) < 8:
+        date = f"{int(date[:-4]) + 1911}{date[-4:]}"
+    try:
+        published = datetime.datetime.strptime(date + time, "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+    return published.replace(tzinfo=TAIPEI)
+
+
+STAGES = {
+    "total": "published → acked",
+    "detect": "published → detected",
+    "enqueue": "detected → enqueued",
+    "send": "enqueued → sent",
+    "ack": "sent → acked",
+}
+
+
+def _duration(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    if seconds < 120:
+        return f"{seconds:.1f}s"
+    return f"{seconds / 60:.1f}m"
+
+
+def _summary(delays: list[float]) -> str:
+    return (
+        f"n={len(delays)} p50 {_duration(percentile(delays, 0.5))} "
+        f"p95 {_duration(percentile(delays, 0.95))} "
+        f"max {_duration(max(delays, default=0))}"
+    )
+
+
+async def report(period: datetime.timedelta, *, top: int = 5) -> str:
+    """Delivery delay percentiles of the news detected within ``period``, overall,
+    for the latest ``top`` crawls and for the ``top`` slowest stocks.
+    """
+    rows = (
+        await News.filter(
+            created_at__gte=get_now() - period, delivery_times__not_isnull=True
+        )
+        .using_db(read_db())
+        .values_list(
+            "stock_id",
+            "date_of_speech",
+            "time_of_speech",
+            "created_at",
+            "delivery_times",
+        )
+    )
+    stages: defaultdict[str, list[float]] = defaultdict(list)
+    # end to end delays, news of one crawl share their created_at
+    crawls: defaultdict[datetime.datetime, list[float]] = defaultdict(list)
+    stocks: defaultdict[str, list[float]] = defaultdict(list)
+    for stock_id, date_of_speech, time_of_speech, detected_at, data in rows:
+        published = published_at(date_of_speech, time_of_speech)
+        detect = (
+            None if published is None else (detected_at - published).total_seconds()
+        )
+        for timing in decode(data):
+            stages["enqueue"].append(timing.enqueued)
+            stages["send"].append(timing.sent - timing.enqueued)
+            stages["ack"].append(timing.acked - timing.sent)
+            if detect is None:
+                continue
+            total = detect + timing.acked
+            stages["detect"].append(detect)
+            stages["total"].append(total)
+            crawls[detected_at].append(total)
+            stocks[stock_id].append(total)
+
+    hours = f"{period.total_seconds() / 3600:g}h"
+    if not stages:
+        return f"no deliveries in the last {hours}"
+    lines = [f"deliveries of the last {hours}, {len(rows)} news"]
+    lines += [
+        f"{label}: {_summary(stages[stage])}"
+        for stage, label in STAGES.items()
+        if stages[stage]
+    ]
+    if crawls:
+        lines += ["", "latest crawls, published → acked"]
+        lines += [
+            f"{crawl.astimezone(TAIPEI):%m-%d %H:%M:%S} {_summary(crawls[crawl])}"
+            for crawl in sorted(crawls, reverse=True)[:top]
+        ]
+    if stocks:
+        lines += ["", "slowest stocks, published → acked"]
+        lines += [
+            f"{stock_id} {_summary(stocks[stock_id])}"
+            for stock_id in sorted(
+                stocks, key=lambda s: percentile(stocks[s], 0.95), reverse=True
+            )[:top]
+        ]
+    return "\n".join(lines)
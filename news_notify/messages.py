@@ -0,0 +1,87 @@
+import json
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Any
+
+from .cache import TTLCache
+from .models import News
+from .utils import shorten
+
+type Payload = dict[str, Any]
+
+# Discord message limits, embeds count toward a shared character budget
+MAX_CONTENT = 2000
+MAX_EMBEDS = 10
+MAX_EMBEDS_LENGTH = 6000
+MAX_EMBED_TITLE = 256
+MAX_EMBED_DESCRIPTION = 4096
+
+
+def stock_url(stock_id: str) -> str:
+    return f"https://goodinfo.tw/tw/StockDetail.asp?STOCK_ID={stock_id}"
+
+
+def news_message(news: News) -> str:
+    """``news`` with its stock loaded, as a single webhook message."""
+    return shorten(f"{news.stock}\n{news}\n{stock_url(news.stock.id)}", MAX_CONTENT)
+
+
+def news_embed(news: News) -> Payload:
+    return {
+        "title": shorten(str(news.stock), MAX_EMBED_TITLE),
+        "description": shorten(str(news).strip(), MAX_EMBED_DESCRIPTION),
+        "url": stock_url(news.stock.id),
+    }
+
+
+def digest_payloads(news_embeds: Iterable[Payload]) -> list[Payload]:
+    """Pack embeds into as few webhook payloads as Discord allows."""
+    payloads: list[Payload] = []
+    embeds: list[Payload] = []
+    length = 0
+    for embed in news_embeds:
+        embed_length = len(embed["title"]) + len(embed["description"])
+        if embeds and (
+            len(embeds) == MAX_EMBEDS or length + embed_length > MAX_EMBEDS_LENGTH
+        ):
+            payloads.append({"embeds": embeds})
+            embeds, length = [], 0
+        embeds.append(embed)
+        length += embed_length
+    if embeds:
+        payloads.append({"embeds": embeds})
+
+    for payload in payloads:
+        payload["content"] = f"📢 {len(payload['embeds'])} 則新的重大訊息"
+    return payloads
+
+
+@dataclass(frozen=True, slots=True)
+class RenderedNews:
+    text: str
+    # webhook body of text, encoded once and shared by every recipient
+    body: bytes
+    embed: Payload
+
+
+class MessageRenderer:
+    """Renders each news once, the most recent ones are kept in an LRU cache."""
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self._cache = TTLCache[str, RenderedNews](maxsize)
+
+    def get(self, news_id: str) -> RenderedNews | None:
+        return self._cache.get(news_id)
+
+    def render(self, news: News) -> RenderedNews:
+        """Render ``news``, which must have its stock loaded."""
+        rendered = self._cache.get(news.id)
+        if rendered is None:
+            text = news_message(news)
+            rendered = RenderedNews(
+                text=text,
+                body=json.dumps({"content": text}, ensure_ascii=False).encode(),
+                embed=news_embed(news),
+            )
+            self._cache.set(news.id, rendered)
+        return rendered
@@ -0,0 +1,260 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from functools import wraps
+from typing import Any
+
+from aiohttp import web
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from .db import pool_stats
+
+# seconds, from a fast query up to a slow crawl
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+)  # fmt: skip
+
+type Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_labels(names: Labels, values: Labels, **extra: str) -> str:
+    pairs = [*zip(names, values, strict=True), *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        REGISTRY.register(self)
+
+    def _label_values(self, labels: dict[str, str]) -> Labels:
+        if labels.keys() != set(self.label_names):
+            msg = f"Metric {self.name} takes labels {self.label_names}, got {tuple(labels)}"
+            raise ValueError(msg)
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = (
+            f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.type}\n"
+        )
+        return header + "".join(f"{line}\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, values)} {value}"
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[Labels, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._label_values(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        for values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, values)} {value}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        *,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # observations per bucket, the last one is +Inf
+        self._counts: dict[Labels, list[int]] = {}
+        self._sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for values, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                labels = _format_labels(self.label_names, values, le=str(bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, values)
+            yield f"{self.name}_sum{labels} {self._sums[values]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Callable[[], Awaitable[None]]] = []
+
+    def register(self, metric: _Metric) -> None:
+        if metric.name in self._metrics:
+            msg = f"Metric {metric.name!r} already exists"
+            raise ValueError(msg)
+        self._metrics[metric.name] = metric
+
+    def add_collector(self, collector: Callable[[], Awaitable[None]]) -> None:
+        """Run ``collector`` before every scrape, to update gauges that are costly
+        to keep current.
+        """
+        self._collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                await collector()
+            except Exception:
+                logging.exception("Metrics collector %s failed", collector)
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+REGISTRY = Registry()
+
+CRAWL_PHASE_SECONDS = Histogram(
+    "news_notify_crawl_phase_seconds", "Time spent in each crawl_news phase", ("phase",)
+)
+CRAWLED_NEWS = Counter("news_notify_crawled_news_total", "New announcements crawled")
+COMMAND_SECONDS = Histogram(
+    "news_notify_command_seconds", "Time to handle a LINE command", ("command",)
+)
+COMMANDS = Counter(
+    "news_notify_commands_total", "Handled LINE commands", ("command", "result")
+)
+WEBHOOK_SECONDS = Histogram(
+    "news_notify_webhook_seconds",
+    "Time to send a webhook, including retries",
+    ("result",),
+)
+WEBHOOK_RESPONSES = Counter(
+    "news_notify_webhook_responses_total",
+    "Webhook HTTP responses by status, error for failed requests",
+    ("status",),
+)
+DELIVERIES = Counter(
+    "news_notify_deliveries_total", "Processed outbox deliveries", ("result",)
+)
+DELIVERY_LATENCY_SECONDS = Histogram(
+    "news_notify_delivery_latency_seconds",
+    "Time from queueing a delivery to the webhook accepting it",
+)
+OUTBOX_DEPTH = Gauge(
+    "news_notify_outbox_depth", "Deliveries in the outbox by status", ("status",)
+)
+DB_QUERY_SECONDS = Histogram(
+    "news_notify_db_query_seconds", "Database query time", ("method",)
+)
+DB_POOL_WAIT_SECONDS = Gauge(
+    "news_notify_db_pool_wait_seconds",
+    "Wait for a pooled database connection, recent p95 and overall max",
+    ("connection", "stat"),
+)
+LINE_EVENTS = Counter(
+    "news_notify_line_events_total",
+    "LINE webhook events by intake result, when events are queued",
+    ("result",),
+)
+LINE_EVENT_QUEUE_DEPTH = Gauge(
+    "news_notify_line_event_queue_depth", "LINE events waiting to be handled"
+)
+EVENT_LOOP_LAG_SECONDS = Gauge(
+    "news_notify_event_loop_lag_seconds", "How late the last event loop probe ran"
+)
+
+
+def instrument_queries(client: BaseDBAsyncClient) -> None:
+    """Time every query of ``client`` (queries in transactions are not included)."""
+    for method in (
+        "execute_query",
+        "execute_query_dict",
+        "execute_insert",
+        "execute_many",
+    ):
+        original = getattr(client, method)
+
+        @wraps(original)
+        async def timed(
+            *args: Any, _original: Any = original, _method: str = method, **kwargs: Any
+        ) -> Any:
+            with DB_QUERY_SECONDS.time(method=_method):
+                return await _original(*args, **kwargs)
+
+        setattr(client, method, timed)
+
+
+async def _collect_pool_stats() -> None:
+    for name, stats in pool_stats.items():
+        DB_POOL_WAIT_SECONDS.set(stats.percentile(0.95), connection=name, stat="p95")
+        DB_POOL_WAIT_SECONDS.set(stats.max_wait, connection=name, stat="max")
+
+
+REGISTRY.add_collector(_collect_pool_stats)
+
+
+async def monitor_event_loop(interval: float = 0.5) -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.set(max(time.perf_counter() - start - interval, 0))
+
+
+async def handle_metrics(_: web.Request) -> web.Response:
+    return web.Response(
+        text=await REGISTRY.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def start_metrics_server(port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
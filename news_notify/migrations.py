@@ -0,0 +1,221 @@
+import asyncio
+import logging
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
+
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import OperationalError
+from tortoise.functions import Length
+
+from . import notified
+from .models import BotState, News, User, padded_time
+from .utils import get_now, split_list
+
+# Tortoise's generate_schemas only creates missing tables, so changes to existing
+# tables are applied here. Every migration must be safe to run on a database
+# that generate_schemas already created with the latest schema.
+
+type Migration = Callable[[BaseDBAsyncClient], Awaitable[None]]
+
+
+async def _has_column(db: BaseDBAsyncClient, table: str, column: str) -> bool:
+    if db.capabilities.dialect == "sqlite":
+        rows = await db.execute_query_dict(f'PRAGMA table_info("{table}")')
+        return any(row["name"] == column for row in rows)
+    rows = await db.execute_query_dict(
+        "SELECT 1 FROM information_schema.columns "
+        f"WHERE table_name = '{table}' AND column_name = '{column}'"
+    )
+    return bool(rows)
+
+
+async def _has_table(db: BaseDBAsyncClient, table: str) -> bool:
+    if db.capabilities.dialect == "sqlite":
+        rows = await db.execute_query_dict(
+            f"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '{table}'"
+        )
+    else:
+        rows = await db.execute_query_dict(
+            f"SELECT 1 FROM information_schema.tables WHERE table_name = '{table}'"
+        )
+    return bool(rows)
+
+
+async def _add_column(
+    db: BaseDBAsyncClient, table: str, column: str, definition: str
+) -> bool:
+    if await _has_column(db, table, column):
+        return False
+    await db.execute_script(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+    return True
+
+
+async def news_columns(db: BaseDBAsyncClient) -> None:
+    await _add_column(db, "news", "date_of_speech", "VARCHAR(20) NOT NULL DEFAULT ''")
+    await _add_column(db, "news", "time_of_speech", "VARCHAR(20) NOT NULL DEFAULT ''")
+    await _add_column(db, "news", "title", "TEXT NOT NULL DEFAULT ''")
+    await db.execute_script(
+        'CREATE INDEX IF NOT EXISTS "idx_news_stock_i_date" '
+        'ON "news" ("stock_id", "date_of_speech", "time_of_speech")'
+    )
+    # subscriber lookups filter the join table by stock, the unique index
+    # generated for it starts with user_id
+    await db.execute_script(
+        'CREATE INDEX IF NOT EXISTS "idx_user_stock_stock_id" '
+        'ON "user_stock" ("stock_id", "user_id")'
+    )
+
+    backfilled = 0
+    last_id = ""
+    while rows := (
+        await News.filter(date_of_speech="", id__gt=last_id)
+        .order_by("id")
+        .limit(500)
+        .values_list("id", "data")
+    ):
+        await News.bulk_update(
+            [
+                News(
+                    id=news_id,
+                    date_of_speech=data.get("date_of_speech", ""),
+                    time_of_speech=data.get("time_of_speech", ""),
+                    title=data.get("title", ""),
+                )
+                for news_id, data in rows
+            ],
+            fields=["date_of_speech", "time_of_speech", "title"],
+        )
+        backfilled += len(rows)
+        last_id = rows[-1][0]
+    logging.info("Backfilled columns of %d news", backfilled)
+
+
+async def notified_sets(db: BaseDBAsyncClient) -> None:
+    binary, timestamp = {
+        "sqlite": ("BLOB", "TIMESTAMP"),
+        "postgres": ("BYTEA", "TIMESTAMPTZ"),
+    }.get(db.capabilities.dialect, ("LONGBLOB", "DATETIME(6)"))
+    if await _add_column(db, "user", "ordinal", "INT"):
+        await db.execute_script(
+            'CREATE UNIQUE INDEX IF NOT EXISTS "uid_user_ordinal" ON "user" ("ordinal")'
+        )
+    await _add_column(db, "news", "notified", binary)
+    if await _add_column(db, "news", "created_at", timestamp):
+        # unknown for existing news, count their retention from now on
+        await News.all().update(created_at=get_now())
+
+    ordinals: dict[str, int] = dict(
+        await User.filter(ordinal__not_isnull=True).values_list("id", "ordinal")
+    )
+    next_ordinal = max(ordinals.values(), default=0) + 1
+    users = await User.filter(ordinal__isnull=True).order_by("id").only("id")
+    for ordinal, user in enumerate(users, start=next_ordinal):
+        user.ordinal = ordinal
+        ordinals[user.id] = ordinal
+    for chunk in split_list(users, 500):
+        await User.bulk_update(chunk, fields=["ordinal"])
+
+    # move the old News.notified_users join table into News.notified
+    if not await _has_table(db, "news_user"):
+        return
+    notified_users: defaultdict[str, set[int]] = defaultdict(set)
+    for row in await db.execute_query_dict(
+        'SELECT "news_id", "user_id" FROM "news_user"'
+    ):
+        if (ordinal := ordinals.get(row["user_id"])) is not None:
+            notified_users[row["news_id"]].add(ordinal)
+    for chunk in split_list(list(notified_users.items()), 500):
+        await News.bulk_update(
+            [
+                News(id=news_id, notified=notified.encode(users))
+                for news_id, users in chunk
+            ],
+            fields=["notified"],
+        )
+    await db.execute_script('DROP TABLE "news_user"')
+    logging.info("Moved notified users of %d news", len(notified_users))
+
+
+async def user_digest(db: BaseDBAsyncClient) -> None:
+    boolean = "INT" if db.capabilities.dialect == "sqlite" else "BOOL"
+    await _add_column(db, "user", "digest", f"{boolean} NOT NULL DEFAULT FALSE")
+
+
+async def delivery_shards(db: BaseDBAsyncClient) -> None:
+    await _add_column(db, "delivery", "shard", "SMALLINT NOT NULL DEFAULT 0")
+    await db.execute_script(
+        'CREATE INDEX IF NOT EXISTS "idx_delivery_status_shard" '
+        'ON "delivery" ("status", "shard", "available_at")'
+    )
+
+
+async def delivery_times(db: BaseDBAsyncClient) -> None:
+    binary = {"sqlite": "BLOB", "postgres": "BYTEA"}.get(
+        db.capabilities.dialect, "LONGBLOB"
+    )
+    await _add_column(db, "news", "delivery_times", binary)
+
+
+async def padded_times(_: BaseDBAsyncClient) -> None:
+    # news stored before time_of_speech was padded sort after later ones
+    padded = 0
+    last_id = ""
+    while rows := (
+        await News.annotate(length=Length("time_of_speech"))
+        .filter(length__gt=0, length__lt=6, id__gt=last_id)
+        .order_by("id")
+        .limit(500)
+        .values_list("id", "time_of_speech")
+    ):
+        await News.bulk_update(
+            [
+                News(id=news_id, time_of_speech=padded_time(time))
+                for news_id, time in rows
+            ],
+            fields=["time_of_speech"],
+        )
+        padded += len(rows)
+        last_id = rows[-1][0]
+    logging.info("Padded the time of %d news", padded)
+
+
+MIGRATIONS: list[Migration] = [
+    news_columns,
+    notified_sets,
+    user_digest,
+    delivery_shards,
+    delivery_times,
+    padded_times,
+]
+
+
+async def migrate() -> None:
+    """Bring the schema up to date. Only the bot process runs this, other
+    processes ``wait_for_schema``, so migrations never run concurrently.
+    """
+    state, _ = await BotState.get_or_create(id="schema", defaults={"data": {}})
+    version: int = state.data.get("version", 0)
+    db = Tortoise.get_connection("default")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info("Running migration %d: %s", number, migration.__name__)
+        await migration(db)
+        state.data = {"version": number}
+        await state.save(update_fields=["data"])
+
+
+async def wait_for_schema(interval: float = 2) -> None:
+    """Wait until the bot process created the tables and ran every migration."""
+    logged = False
+    while True:
+        try:
+            state = await BotState.get_or_none(id="schema")
+        except OperationalError:
+            # no tables yet
+            state = None
+        if state is not None and state.data.get("version", 0) >= len(MIGRATIONS):
+            return
+        if not logged:
+            logging.info("Waiting for the bot to set up the database schema")
+            logged = True
+        await asyncio.sleep(interval)
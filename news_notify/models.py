@@ -1,7 +1,13 @@
+import datetime
+from collections.abc import Collection
+from enum import IntEnum
 
+from pypika_tortoise.queries import Table
 from tortoise import fields
 from tortoise.models import Model
 
+from .utils import get_now, split_list
+
 
 class User(Model):
     id = fields.CharField(max_length=33, pk=True)
@@ -11,7 +17,11 @@ class User(Model):
     line_notify_token: str | None = fields.CharField(max_length=255, null=True)  # type: ignore
     line_notify_state: str | None = fields.CharField(max_length=255, null=True)  # type: ignore
     temp_data: str | None = fields.TextField(null=True)  # type: ignore
-    notified_news: fields.ManyToManyRelation["News"]
+    # small integer surrogate key, stored in News.notified
+    ordinal: int | None = fields.IntField(null=True, unique=True)  # type: ignore
+    # bundle each batch of news into as few webhook messages as possible
+    digest = fields.BooleanField(default=False)
+    deliveries: fields.ReverseRelation["Delivery"]
 
 
 class Stock(Model):
@@ -27,15 +37,118 @@ class Stock(Model):
 class News(Model):
     id = fields.CharField(max_length=100, pk=True)
     data: fields.Field[dict[str, str]] = fields.JSONField()  # type: ignore
+    # copied out of data so they can be selected and sorted on their own,
+    # (stock_id, date_of_speech, time_of_speech) is indexed in migrations.py.
+    # time_of_speech is zero padded, see padded_time
+    date_of_speech = fields.CharField(max_length=20, default="")
+    time_of_speech = fields.CharField(max_length=20, default="")
+    title = fields.TextField(default="")
     stock: fields.ForeignKeyRelation[Stock] = fields.ForeignKeyField(
         "models.Stock", related_name="news"
     )
-    notified_users: fields.ManyToManyRelation[User] = fields.ManyToManyField(
-        "models.User", related_name="notified_news"
+    # ordinals of the notified users, see notified.py
+    notified: bytes | None = fields.BinaryField(null=True)  # type: ignore
+    # when each notified user was enqueued, sent and acknowledged, see latency.py
+    delivery_times: bytes | None = fields.BinaryField(null=True)  # type: ignore
+    # when a crawl detected the news, shared by the news of that crawl
+    created_at: datetime.datetime | None = fields.DatetimeField(  # type: ignore
+        null=True, default=get_now
     )
+    deliveries: fields.ReverseRelation["Delivery"]
 
     def __str__(self) -> str:
-        return (
-            f"發言日期: {self.data['date_of_speech']}\n"
-            f"主旨: {self.data['title']}\n\n"
-        )
+        return f"發言日期: {self.date_of_speech}\n主旨: {self.title}\n\n"
+
+
+class DeliveryStatus(IntEnum):
+    PENDING = 0
+    DEAD = 1
+
+
+class Delivery(Model):
+    """Outbox row for a news notification that still has to reach a user.
+
+    Rows are deleted once delivered (the user then is in ``News.notified``);
+    rows that keep failing are kept as ``DEAD`` for inspection.
+    """
+
+    id = fields.BigIntField(pk=True)
+    news: fields.ForeignKeyRelation[News] = fields.ForeignKeyField(
+        "models.News", related_name="deliveries"
+    )
+    user: fields.ForeignKeyRelation[User] = fields.ForeignKeyField(
+        "models.User", related_name="deliveries"
+    )
+    user_id: str
+    # partition of the user, lets worker processes split the outbox
+    shard = fields.SmallIntField(default=0)
+    status = fields.IntEnumField(DeliveryStatus, default=DeliveryStatus.PENDING)
+    attempts = fields.SmallIntField(default=0)
+    # claimable again after this time, used both as lease expiry and retry backoff
+    available_at = fields.DatetimeField(default=get_now)
+    last_error: str | None = fields.TextField(null=True)  # type: ignore
+    created_at = fields.DatetimeField(default=get_now)
+
+    class Meta(Model.Meta):
+        unique_together = (("news", "user"),)
+        indexes = (("status", "available_at"),)
+
+
+class BotState(Model):
+    """Small JSON documents the bot keeps across restarts, keyed by name."""
+
+    id = fields.CharField(max_length=50, pk=True)
+    data: fields.Field[dict] = fields.JSONField(default=dict)  # type: ignore
+    updated_at = fields.DatetimeField(default=get_now)
+
+
+def padded_time(time_of_speech: str) -> str:
+    """Zero pad an HHMMSS time, so "93512" sorts before "173205"."""
+    return time_of_speech.zfill(6) if time_of_speech.isdigit() else time_of_speech
+
+
+async def bulk_add_relations(
+    model: type[Model],
+    field_name: str,
+    pairs: Collection[tuple[str, str]],
+    *,
+    chunk_size: int = 5000,
+) -> set[tuple[str, str]]:
+    """Link many (instance pk, related pk) pairs of a M2M field with one INSERT
+    per ``chunk_size`` pairs, which keeps each query within the bind parameter
+    limit of the database.
+
+    Unlike ``ManyToManyRelation.add`` this spans multiple owning instances.
+    Pairs that are already linked are skipped, the newly linked ones are returned.
+    """
+    added: set[tuple[str, str]] = set()
+    for chunk in split_list(list(pairs), chunk_size):
+        added |= await _add_relations(model, field_name, chunk)
+    return added
+
+
+async def _add_relations(
+    model: type[Model], field_name: str, pairs: Collection[tuple[str, str]]
+) -> set[tuple[str, str]]:
+    field = model._meta.fields_map[field_name]
+    db = model._meta.db
+    through_table = Table(field.through)  # type: ignore
+    backward_field = through_table[field.backward_key]  # type: ignore
+    forward_field = through_table[field.forward_key]  # type: ignore
+
+    select_query = (
+        db.query_class.from_(through_table)
+        .select(backward_field, forward_field)
+        .where(backward_field.isin(list({pk_b for pk_b, _ in pairs})))
+        .where(forward_field.isin(list({pk_f for _, pk_f in pairs})))
+    )
+    _, rows = await db.execute_query(*select_query.get_parameterized_sql())
+    existing = {(row[0], row[1]) for row in rows}
+    if not (pairs_to_insert := set(pairs) - existing):
+        return set()
+
+    query = db.query_class.into(through_table).columns(backward_field, forward_field)
+    for pk_b, pk_f in pairs_to_insert:
+        query = query.insert(pk_b, pk_f)
+    await db.execute_query(*query.get_parameterized_sql())
+    return pairs_to_insert
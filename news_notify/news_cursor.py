@@ -0,0 +1,107 @@
+import datetime
+import hashlib
+from collections import OrderedDict
+from collections.abc import Iterable, Sequence
+from typing import Protocol
+
+from .latency import published_at
+from .models import BotState
+from .utils import get_now
+
+
+class NewsItem(Protocol):
+    stock_id: str
+    date_of_speech: str
+    time_of_speech: str
+    title: str
+
+    def model_dump_json(self) -> str: ...
+
+
+class NewsCursor:
+    """Remembers which announcements were already processed, so a crawl can drop
+    them before touching the database.
+
+    Items published more than ``margin`` before the latest processed one (the
+    watermark) are skipped, so are items whose content fingerprint was seen. The
+    margin lets announcements that are listed late still through. Items whose
+    publication time can't be parsed are only checked by fingerprint. Both are
+    persisted in ``BotState`` and survive restarts.
+    """
+
+    key = "news_cursor"
+
+    def __init__(
+        self,
+        *,
+        max_fingerprints: int = 2000,
+        margin: datetime.timedelta = datetime.timedelta(days=1),
+    ) -> None:
+        self.max_fingerprints = max_fingerprints
+        self.margin = margin
+        self.watermark: datetime.datetime | None = None
+        self._fingerprints: OrderedDict[str, None] = OrderedDict()
+        self._dirty = False
+
+    @staticmethod
+    def fingerprint(item: NewsItem) -> str:
+        return hashlib.blake2b(
+            item.model_dump_json().encode(), digest_size=8
+        ).hexdigest()
+
+    async def load(self) -> None:
+        state = await BotState.get_or_none(id=self.key)
+        if state is None:
+            return
+        # older versions stored the raw (date, time) strings, which don't compare
+        # correctly, they are dropped
+        if isinstance(watermark := state.data.get("watermark"), str):
+            self.watermark = datetime.datetime.fromisoformat(watermark)
+        self._fingerprints = OrderedDict.fromkeys(state.data.get("fingerprints", []))
+
+    async def save(self) -> None:
+        if not self._dirty:
+            return
+        await BotState.update_or_create(
+            id=self.key,
+            defaults={
+                "data": {
+                    "watermark": self.watermark and self.watermark.isoformat(),
+                    "fingerprints": list(self._fingerprints),
+                },
+                "updated_at": get_now(),
+            },
+        )
+        self._dirty = False
+
+    def _is_old(self, item: NewsItem) -> bool:
+        if self.watermark is None:
+            return False
+        published = published_at(item.date_of_speech, item.time_of_speech)
+        return published is not None and published < self.watermark - self.margin
+
+    def filter_new[T: NewsItem](self, items: Iterable[T]) -> list[T]:
+        return [
+            item
+            for item in items
+            if not self._is_old(item)
+            and self.fingerprint(item) not in self._fingerprints
+        ]
+
+    def advance(self, items: Sequence[NewsItem]) -> None:
+        """Mark ``items`` as processed, only pass the ones that were stored."""
+        if not items:
+            return
+        for item in items:
+            self._fingerprints[self.fingerprint(item)] = None
+        while len(self._fingerprints) > self.max_fingerprints:
+            self._fingerprints.popitem(last=False)
+
+        published = [
+            p
+            for item in items
+            if (p := published_at(item.date_of_speech, item.time_of_speech)) is not None
+        ]
+        if published and (self.watermark is None or max(published) > self.watermark):
+            self.watermark = max(published)
+        self._dirty = True
@@ -0,0 +1,87 @@
+import datetime
+import struct
+from collections.abc import Collection, Mapping
+from typing import cast
+
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import Subquery
+from tortoise.functions import Max
+from tortoise.transactions import in_transaction
+
+from .models import Delivery, DeliveryStatus, News, User
+from .utils import get_now
+
+# News.notified holds the ordinals of every notified user as a sorted array of
+# little-endian uint32, a few bytes per user instead of a join table row.
+
+# news older than this are not crawled again, so who was notified is forgotten
+RETENTION = datetime.timedelta(days=30)
+
+
+def decode(data: bytes | None) -> set[int]:
+    if not data:
+        return set()
+    return set(struct.unpack(f"<{len(data) // 4}I", data))
+
+
+def encode(ordinals: Collection[int]) -> bytes | None:
+    if not ordinals:
+        return None
+    return struct.pack(f"<{len(ordinals)}I", *sorted(ordinals))
+
+
+async def assign_ordinal(user: User) -> int:
+    """Give ``user`` the next free ordinal if it does not have one yet."""
+    while user.ordinal is None:
+        max_ordinals = await User.annotate(max_ordinal=Max("ordinal")).values_list(
+            "max_ordinal", flat=True
+        )
+        user.ordinal = (cast(int | None, max_ordinals[0]) or 0) + 1
+        try:
+            await user.save(update_fields=["ordinal"])
+        except IntegrityError:
+            # another process took it
+            user.ordinal = None
+    return user.ordinal
+
+
+async def mark_notified(
+    notified: Mapping[str, Collection[int]],
+    delivery_times: Mapping[str, bytes] | None = None,
+) -> None:
+    """Add user ordinals to the notified set of each news, keyed by news ID.
+
+    ``delivery_times`` are latency records to append to each news, see latency.py.
+    """
+    if not notified:
+        return
+    delivery_times = delivery_times or {}
+    async with in_transaction() as conn:
+        # a model query, values_list() would drop the FOR UPDATE
+        news = (
+            await News.filter(id__in=notified.keys())
+            .select_for_update()
+            .using_db(conn)
+            .only("id", "notified", "delivery_times")
+        )
+        for n in news:
+            n.notified = encode(decode(n.notified) | set(notified[n.id]))
+            times = (n.delivery_times or b"") + delivery_times.get(n.id, b"")
+            n.delivery_times = times or None
+        await News.bulk_update(
+            news, fields=["notified", "delivery_times"], using_db=conn
+        )
+
+
+async def compact(retention: datetime.timedelta) -> None:
+    """Forget who was notified of news older than ``retention`` and when, along
+    with dead-lettered deliveries of that news.
+    """
+    cutoff = get_now() - retention
+    await Delivery.filter(
+        status=DeliveryStatus.DEAD,
+        news_id__in=Subquery(News.filter(created_at__lt=cutoff).values("id")),
+    ).delete()
+    await News.filter(created_at__lt=cutoff, notified__not_isnull=True).update(
+        notified=None, delivery_times=None
+    )
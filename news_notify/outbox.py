@@ -0,0 +1,279 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import zlib
+from collections import defaultdict
+from collections.abc import Collection
+from itertools import islice
+
+from tortoise.expressions import F
+from tortoise.functions import Count
+from tortoise.transactions import in_transaction
+
+from . import latency, notified
+from .messages import MessageRenderer, Payload, digest_payloads
+from .metrics import DELIVERIES, DELIVERY_LATENCY_SECONDS
+from .models import Delivery, DeliveryStatus
+from .utils import get_now
+from .webhook import WebhookResult, WebhookSender
+
+# deliveries are spread over this many shards by user, so each user's
+# deliveries stay in order within one worker
+SHARDS = 64
+
+
+def shard_of(user_id: str) -> int:
+    return zlib.crc32(user_id.encode()) % SHARDS
+
+
+def worker_shards(index: int, count: int) -> list[int]:
+    """Shards owned by worker ``index`` of ``count``."""
+    if not 0 <= index < count <= SHARDS:
+        msg = f"Worker index {index} is out of range for {count} workers"
+        raise ValueError(msg)
+    return [shard for shard in range(SHARDS) if shard % count == index]
+
+
+class Outbox:
+    """Drains the ``Delivery`` table with a pool of async workers.
+
+    Claimed rows are leased for ``lease`` seconds, so deliveries of a worker that
+    died mid-send become claimable again. Delivery is at-least-once.
+
+    With ``shards`` set only deliveries of those shards are claimed, which is how
+    the processes started by ``worker.py`` split the outbox between them. The
+    shards are split again between the workers, so all deliveries of a user are
+    handled by one worker, which claims them whole to keep digests together.
+    """
+
+    def __init__(
+        self,
+        webhook: WebhookSender,
+        *,
+        workers: int = 4,
+        batch_size: int = 100,
+        lease: float = 60,
+        max_attempts: int = 5,
+        poll_interval: float = 30,
+        renderer: MessageRenderer | None = None,
+        shards: Collection[int] | None = None,
+    ) -> None:
+        self.webhook = webhook
+        self.renderer = renderer or MessageRenderer()
+        self.shards = None if shards is None else list(shards)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease = datetime.timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+        # one per worker, a worker clearing its own can't drop another's wakeup
+        self._wakeups: list[asyncio.Event] = []
+        self._tasks: list[asyncio.Task] = []
+
+    async def enqueue(self, pairs: Collection[tuple[str, str]]) -> None:
+        """Queue (news_id, user_id) deliveries, ignoring pairs that are already queued."""
+        if not pairs:
+            return
+        await Delivery.bulk_create(
+            [
+                Delivery(news_id=news_id, user_id=user_id, shard=shard_of(user_id))
+                for news_id, user_id in pairs
+            ],
+            ignore_conflicts=True,
+        )
+        for wakeup in self._wakeups:
+            wakeup.set()
+
+    async def depth(self) -> dict[DeliveryStatus, int]:
+        rows = await (
+            Delivery.annotate(count=Count("id"))
+            .group_by("status")
+            .values_list("status", "count")
+        )
+        depth = dict.fromkeys(DeliveryStatus, 0)
+        depth.update({DeliveryStatus(status): count for status, count in rows})
+        return depth
+
+    def start(self) -> None:
+        shards = list(range(SHARDS)) if self.shards is None else self.shards
+        self._wakeups = [asyncio.Event() for _ in range(min(self.workers, len(shards)))]
+        self._tasks = [
+            asyncio.create_task(
+                self._work(shards[i :: self.workers], wakeup),
+                name=f"outbox-worker-{i}",
+            )
+            for i, wakeup in enumerate(self._wakeups)
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks.clear()
+        self._wakeups.clear()
+
+    async def _work(self, shards: list[int], wakeup: asyncio.Event) -> None:
+        while True:
+            # cleared before claiming, so an enqueue during the batch isn't lost
+            wakeup.clear()
+            try:
+                claimed = await self.process_batch(shards)
+            except Exception:
+                logging.exception("Outbox worker failed to process a batch")
+                claimed = 0
+
+            if claimed < self.batch_size:
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+
+    async def claim(self, shards: Collection[int] | None = None) -> list[Delivery]:
+        """Claim up to ``batch_size`` deliveries, plus the remaining claimable
+        deliveries of their users, from ``shards`` or else the outbox's shards.
+        """
+        now = get_now()
+        shards = self.shards if shards is None else shards
+        query = Delivery.filter(status=DeliveryStatus.PENDING, available_at__lte=now)
+        if shards is not None:
+            query = query.filter(shard__in=shards)
+        async with in_transaction() as conn:
+            # values_list() would drop the FOR UPDATE, so rows are locked through
+            # a model query
+            locked = await (
+                query.order_by("id")
+                .limit(self.batch_size)
+                .select_for_update(skip_locked=True)
+                .using_db(conn)
+                .only("id", "user_id")
+            )
+            if not locked:
+                return []
+            # the rest of these users' deliveries, so digests are not split between
+            # batches. Their shards belong to this worker, no one else claims them.
+            rest = await (
+                query.filter(
+                    user_id__in={d.user_id for d in locked}, id__gt=locked[-1].id
+                )
+                .select_for_update(skip_locked=True)
+                .using_db(conn)
+                .only("id")
+            )
+            ids = [d.id for d in locked + rest]
+            await (
+                Delivery.filter(id__in=ids)
+                .using_db(conn)
+                .update(available_at=now + self.lease, attempts=F("attempts") + 1)
+            )
+        return (
+            await Delivery.filter(id__in=ids)
+            .select_related("news__stock", "user")
+            .order_by("id")
+        )
+
+    async def process_batch(self, shards: Collection[int] | None = None) -> int:
+        deliveries = await self.claim(shards)
+        claimed = len(deliveries)
+        if not claimed:
+            return 0
+
+        # each notified set is decoded once, membership checks are then O(1)
+        notified_sets: dict[str, set[int]] = {}
+        for d in deliveries:
+            if d.news.id not in notified_sets:
+                notified_sets[d.news.id] = notified.decode(d.news.notified)
+        # the user removed their webhook while the delivery was queued, or was
+        # already notified of this news by an earlier delivery
+        skipped = [
+            d
+            for d in deliveries
+            if d.user.line_notify_token is None
+            or d.user.ordinal in notified_sets[d.news.id]
+        ]
+        deliveries = [d for d in deliveries if d not in skipped]
+
+        # digest users get all their news of the batch in as few messages as
+        # possible, everyone else gets one message per news
+        sends: list[tuple[bytes | Payload, str, list[Delivery]]] = []
+        digests: defaultdict[str, list[Delivery]] = defaultdict(list)
+        for d in deliveries:
+            if d.user.digest:
+                digests[d.user.id].append(d)
+            else:
+                body = self.renderer.render(d.news).body
+                sends.append((body, d.user.line_notify_token, [d]))  # type: ignore
+        for user_deliveries in digests.values():
+            url: str = user_deliveries[0].user.line_notify_token  # type: ignore
+            remaining = iter(user_deliveries)
+            for payload in digest_payloads(
+                self.renderer.render(d.news).embed for d in user_deliveries
+            ):
+                sends.append(
+                    (payload, url, list(islice(remaining, len(payload["embeds"]))))
+                )
+
+        results = await self.webhook.send_many(
+            (message, url) for message, url, _ in sends
+        )
+
+        done: list[tuple[Delivery, WebhookResult]] = []
+        failed: list[tuple[Delivery, WebhookResult]] = []
+        for (_, _, sent), result in zip(sends, results, strict=True):
+            (done if result.ok else failed).extend((d, result) for d in sent)
+        notified_users: defaultdict[str, set[int]] = defaultdict(set)
+        timings: defaultdict[str, list[latency.DeliveryTiming]] = defaultdict(list)
+        # every delivery has its own User instance, an ordinal is assigned once
+        # per user
+        ordinals: dict[str, int] = {}
+        for d, result in done:
+            if d.user.id not in ordinals:
+                ordinals[d.user.id] = await notified.assign_ordinal(d.user)
+            ordinal = ordinals[d.user.id]
+            notified_users[d.news.id].add(ordinal)
+            if (detected_at := d.news.created_at) is not None:
+                timings[d.news.id].append(
+                    latency.DeliveryTiming(
+                        ordinal,
+                        enqueued=(d.created_at - detected_at).total_seconds(),
+                        sent=(result.sent_at - detected_at).total_seconds(),  # type: ignore
+                        acked=(result.acked_at - detected_at).total_seconds(),  # type: ignore
+                    )
+                )
+
+        now = get_now()
+        async with in_transaction():
+            await notified.mark_notified(
+                notified_users,
+                {news_id: latency.encode(t) for news_id, t in timings.items()},
+            )
+            if finished := [d.id for d, _ in done] + [d.id for d in skipped]:
+                await Delivery.filter(id__in=finished).delete()
+
+            for delivery, result in failed:
+                delivery.last_error = f"{result.status} {result.error}"[:1000]
+                if delivery.attempts >= self.max_attempts:
+                    delivery.status = DeliveryStatus.DEAD
+                    logging.error(
+                        "Delivery %d dead-lettered after %d attempts: %s",
+                        delivery.id,
+                        delivery.attempts,
+                        delivery.last_error,
+                    )
+                else:
+                    delivery.available_at = now + datetime.timedelta(
+                        seconds=30 * 2 ** (delivery.attempts - 1)
+                    )
+                await delivery.save(
+                    update_fields=["status", "available_at", "last_error"]
+                )
+
+        for d, _ in done:
+            DELIVERY_LATENCY_SECONDS.observe((now - d.created_at).total_seconds())
+        dead = sum(d.status is DeliveryStatus.DEAD for d, _ in failed)
+        DELIVERIES.inc(len(done), result="sent")
+        DELIVERIES.inc(len(skipped), result="skipped")
+        DELIVERIES.inc(len(failed) - dead, result="retry")
+        DELIVERIES.inc(dead, result="dead")
+        return claimed
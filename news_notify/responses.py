@@ -0,0 +1,73 @@
+from collections.abc import Hashable, Iterable
+from dataclasses import dataclass
+
+from line import Context
+from linebot.v3.messaging import QuickReply, Template
+
+from .cache import TTLCache
+
+# what a cached response was built from, e.g. ("user", user_id) for a user's
+# subscriptions or ("stock", stock_id) for a stock's news
+type Tag = tuple[str, str]
+
+
+@dataclass(frozen=True, slots=True)
+class TemplateReply:
+    alt_text: str
+    template: Template
+    quick_reply: QuickReply | None = None
+
+    async def send(self, ctx: Context) -> None:
+        await ctx.reply_template(
+            self.alt_text, template=self.template, quick_reply=self.quick_reply
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class _Entry:
+    reply: TemplateReply
+    tags: tuple[Tag, ...]
+    built_at: int
+
+
+class ResponseCache:
+    """LRU cache of rendered replies, invalidated by the tags they were built from.
+
+    ``invalidate`` stamps a tag with a new version, entries built before that
+    are misses from then on. Take a ``snapshot`` before reading the data of a
+    reply and pass it to ``set``, so a reply built while its data changed is
+    never served.
+    """
+
+    def __init__(self, maxsize: int = 2048) -> None:
+        self._cache = TTLCache[Hashable, _Entry](maxsize)
+        self._version = 0
+        self._tag_versions: dict[Tag, int] = {}
+
+    def snapshot(self) -> int:
+        return self._version
+
+    def get(self, key: Hashable) -> TemplateReply | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if any(self._tag_versions.get(tag, 0) > entry.built_at for tag in entry.tags):
+            self._cache.pop(key)
+            return None
+        return entry.reply
+
+    def set(
+        self,
+        key: Hashable,
+        reply: TemplateReply,
+        *,
+        tags: Iterable[Tag],
+        since: int,
+        ttl: float | None = None,
+    ) -> None:
+        self._cache.set(key, _Entry(reply, tuple(tags), since), ttl=ttl)
+
+    def invalidate(self, *tags: Tag) -> None:
+        self._version += 1
+        for tag in tags:
+            self._tag_versions[tag] = self._version
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import logging
+from collections.abc import Mapping
+from pathlib import Path
+from typing import cast
+
+import aiohttp
+from line import Bot
+from linebot.v3.messaging import ApiException, RichMenuRequest, RichMenuResponse
+
+from .models import BotState, User
+from .utils import RateLimiter, get_now, split_list
+
+
+class RichMenuSync:
+    """Creates only the rich menus whose request or image changed since the last
+    sync, and reuses the others.
+
+    Menu IDs and content hashes are persisted in ``BotState``, so a restart
+    without changes only lists the existing menus.
+    """
+
+    key = "rich_menus"
+
+    def __init__(self, bot: Bot) -> None:
+        self.bot = bot
+        # name -> rich menu ID
+        self.ids: dict[str, str] = {}
+        # names of the menus created by the last sync
+        self.changed: set[str] = set()
+        self._remote: list[RichMenuResponse] = []
+
+    @staticmethod
+    def fingerprint(request: RichMenuRequest, image: bytes) -> str:
+        digest = hashlib.blake2b(
+            json.dumps(request.to_dict(), sort_keys=True).encode(), digest_size=16
+        )
+        digest.update(image)
+        return digest.hexdigest()
+
+    async def sync(self, menus: Mapping[str, tuple[RichMenuRequest, str]]) -> None:
+        state = await BotState.get_or_none(id=self.key)
+        synced: dict[str, dict[str, str]] = state.data if state is not None else {}
+        self._remote = await self.bot.get_rich_menu_list()
+        remote = {menu.rich_menu_id for menu in self._remote}
+
+        self.ids, self.changed = {}, set()
+        data: dict[str, dict[str, str]] = {}
+        for name, (request, image_path) in menus.items():
+            fingerprint = self.fingerprint(request, Path(image_path).read_bytes())
+            menu = synced.get(name)
+            if menu is None or menu["hash"] != fingerprint or menu["id"] not in remote:
+                logging.info("Creating rich menu %s", name)
+                menu = {
+                    "id": await self.bot.create_rich_menu(request, image_path),
+                    "hash": fingerprint,
+                }
+                self.changed.add(name)
+            self.ids[name] = menu["id"]
+            data[name] = menu
+
+        await BotState.update_or_create(
+            id=self.key, defaults={"data": data, "updated_at": get_now()}
+        )
+
+    async def delete_stale(self) -> None:
+        """Delete the menus that were replaced, once users are moved off them."""
+        keep = set(self.ids.values())
+        for menu in self._remote:
+            if menu.rich_menu_id not in keep:
+                logging.info("Deleting stale rich menu %s", menu.name)
+                await self.bot.delete_rich_menu(menu.rich_menu_id)
+
+
+class RichMenuLinker:
+    """Links every user with a webhook to a rich menu.
+
+    User IDs are read a page at a time and linked in chunks of up to 500, the
+    most LINE accepts per call. Chunks are sent concurrently under a rate limit
+    and retried on failure. The last fully linked user ID is checkpointed in
+    ``BotState``, so an interrupted run resumes there instead of from scratch.
+    """
+
+    key = "rich_menu_link"
+
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        chunk_size: int = 500,
+        page_size: int = 5000,
+        rate: float = 2,
+        max_attempts: int = 3,
+    ) -> None:
+        self.bot = bot
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self._rate_limiter = RateLimiter(rate)
+
+    async def link(self, rich_menu_id: str) -> bool:
+        """Link all users to ``rich_menu_id``, returns whether every user was linked."""
+        await self._checkpoint(rich_menu_id, "")
+        return await self._run(rich_menu_id, "")
+
+    async def resume(self) -> bool:
+        """Finish an interrupted ``link``, returns whether nothing is left to link."""
+        state = await BotState.get_or_none(id=self.key)
+        if state is None:
+            return True
+        logging.info("Resuming rich menu linking after user %s", state.data["after"])
+        return await self._run(state.data["rich_menu_id"], state.data["after"])
+
+    async def _checkpoint(self, rich_menu_id: str, after: str) -> None:
+        await BotState.update_or_create(
+            id=self.key,
+            defaults={
+                "data": {"rich_menu_id": rich_menu_id, "after": after},
+                "updated_at": get_now(),
+            },
+        )
+
+    async def _page(self, after: str) -> list[str]:
+        user_ids = await (
+            User.filter(line_notify_token__not_isnull=True, id__gt=after)
+            .order_by("id")
+            .limit(self.page_size)
+            .values_list("id", flat=True)
+        )
+        return cast(list[str], user_ids)
+
+    async def _run(self, rich_menu_id: str, after: str) -> bool:
+        linked = 0
+        while user_ids := await self._page(after):
+            results = await asyncio.gather(
+                *(
+                    self._link_chunk(rich_menu_id, chunk)
+                    for chunk in split_list(user_ids, self.chunk_size)
+                )
+            )
+            if not all(results):
+                logging.error(
+                    "Stopped linking rich menu after %d users, resuming on next start",
+                    linked,
+                )
+                return False
+            linked += len(user_ids)
+            after = user_ids[-1]
+            await self._checkpoint(rich_menu_id, after)
+
+        await BotState.filter(id=self.key).delete()
+        logging.info("Linked %d users to rich menu %s", linked, rich_menu_id)
+        return True
+
+    async def _link_chunk(self, rich_menu_id: str, user_ids: list[str]) -> bool:
+        for attempt in range(1, self.max_attempts + 1):
+            await self._rate_limiter.wait()
+            try:
+                await self.bot.link_rich_menu_to_users(rich_menu_id, user_ids)
+            except (ApiException, aiohttp.ClientError, TimeoutError):
+                logging.warning(
+                    "Failed to link %d users to rich menu (attempt %d)",
+                    len(user_ids),
+                    attempt,
+                    exc_info=True,
+                )
+                await asyncio.sleep(2 ** (attempt - 1))
+            else:
+                return True
+        return False
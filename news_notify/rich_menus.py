@@ -68,3 +68,10 @@ RICH_MENU_3 = RichMenuRequest(
         ),
     ],
 )
+
+# name -> (request, image), kept in sync with LINE by RichMenuSync
+RICH_MENUS = {
+    "rich_menu_1": (RICH_MENU_1, "assets/rich_menu_1.png"),
+    "rich_menu_2": (RICH_MENU_2, "assets/rich_menu_2.png"),
+    "rich_menu_3": (RICH_MENU_3, "assets/rich_menu_3.png"),
+}
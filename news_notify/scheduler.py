@@ -0,0 +1,264 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import Protocol
+
+from .utils import get_now
+
+
+class Schedule(Protocol):
+    def next_after(self, dt: datetime.datetime) -> datetime.datetime: ...
+
+
+def _parse_cron_field(value: str, min_: int, max_: int) -> list[int]:
+    result: set[int] = set()
+    for part in value.split(","):
+        range_, _, step_ = part.partition("/")
+        step = int(step_) if step_ else 1
+        if range_ == "*":
+            start, end = min_, max_
+        elif "-" in range_:
+            start, end = (int(v) for v in range_.split("-", 1))
+        else:
+            start = int(range_)
+            end = max_ if step_ else start
+        if not (min_ <= start <= end <= max_) or step <= 0:
+            msg = f"Invalid cron field {value!r}"
+            raise ValueError(msg)
+        result.update(range(start, end + 1, step))
+    return sorted(result)
+
+
+class Cron:
+    """A cron expression, ``minute hour day month weekday`` with an optional
+    leading seconds field. Weekdays are 0-6 starting on Sunday (7 is also Sunday).
+    """
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) == 5:
+            fields.insert(0, "0")
+        if len(fields) != 6:
+            msg = f"Cron expression must have 5 or 6 fields, got {expression!r}"
+            raise ValueError(msg)
+
+        self.expression = expression
+        self.seconds = _parse_cron_field(fields[0], 0, 59)
+        self.minutes = _parse_cron_field(fields[1], 0, 59)
+        self.hours = _parse_cron_field(fields[2], 0, 23)
+        self.days = set(_parse_cron_field(fields[3], 1, 31))
+        self.months = set(_parse_cron_field(fields[4], 1, 12))
+        self.weekdays = {d % 7 for d in _parse_cron_field(fields[5], 0, 7)}
+        self._any_day = fields[3] == "*"
+        self._any_weekday = fields[5] == "*"
+
+    def __repr__(self) -> str:
+        return f"Cron({self.expression!r})"
+
+    def _day_matches(self, day: datetime.date) -> bool:
+        if day.month not in self.months:
+            return False
+        day_ok = day.day in self.days
+        weekday_ok = day.isoweekday() % 7 in self.weekdays
+        # like cron, a restricted day and weekday match if either one does
+        if not self._any_day and not self._any_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, dt: datetime.datetime) -> datetime.datetime:
+        dt = dt.replace(microsecond=0) + datetime.timedelta(seconds=1)
+        earliest = (dt.hour, dt.minute, dt.second)
+        day = dt.date()
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        for second in self.seconds:
+                            if day == dt.date() and (hour, minute, second) < earliest:
+                                continue
+                            return datetime.datetime.combine(
+                                day, datetime.time(hour, minute, second), dt.tzinfo
+                            )
+            day += datetime.timedelta(days=1)
+
+        msg = f"{self!r} never fires"
+        raise ValueError(msg)
+
+
+@dataclass(frozen=True, slots=True)
+class TradingCalendar:
+    sessions: tuple[tuple[datetime.time, datetime.time], ...] = (
+        (datetime.time(9), datetime.time(13, 30)),
+    )
+    # Monday is 0, like datetime.weekday()
+    weekdays: frozenset[int] = frozenset(range(5))
+    holidays: frozenset[datetime.date] = frozenset()
+
+    def is_trading_day(self, day: datetime.date) -> bool:
+        return day.weekday() in self.weekdays and day not in self.holidays
+
+    def is_open(self, dt: datetime.datetime) -> bool:
+        if not self.is_trading_day(dt.date()):
+            return False
+        return any(start <= dt.time() < end for start, end in self.sessions)
+
+    def next_open(self, dt: datetime.datetime) -> datetime.datetime:
+        if self.is_open(dt):
+            return dt
+        day = dt.date()
+        for _ in range(366):
+            if self.is_trading_day(day):
+                for start, _ in sorted(self.sessions):
+                    open_at = datetime.datetime.combine(day, start, dt.tzinfo)
+                    if open_at > dt:
+                        return open_at
+            day += datetime.timedelta(days=1)
+
+        msg = "Trading calendar has no open session in the next year"
+        raise ValueError(msg)
+
+
+# Taiwan Stock Exchange regular session
+TWSE_CALENDAR = TradingCalendar()
+
+
+class Interval:
+    """Fire every ``seconds``, aligned to the clock, optionally only while
+    ``calendar`` is open.
+    """
+
+    def __init__(
+        self, seconds: float, *, calendar: TradingCalendar | None = None
+    ) -> None:
+        if seconds <= 0:
+            msg = "Interval must be positive"
+            raise ValueError(msg)
+        self.seconds = seconds
+        self.calendar = calendar
+
+    def __repr__(self) -> str:
+        return f"Interval({self.seconds}, calendar={self.calendar!r})"
+
+    def next_after(self, dt: datetime.datetime) -> datetime.datetime:
+        timestamp = dt.timestamp()
+        next_timestamp = (timestamp // self.seconds + 1) * self.seconds
+        next_dt = dt + datetime.timedelta(seconds=next_timestamp - timestamp)
+        if self.calendar is not None and not self.calendar.is_open(next_dt):
+            return self.calendar.next_open(next_dt)
+        return next_dt
+
+
+class AnyOf:
+    def __init__(self, *schedules: Schedule) -> None:
+        self.schedules = schedules
+
+    def __repr__(self) -> str:
+        return f"AnyOf{self.schedules!r}"
+
+    def next_after(self, dt: datetime.datetime) -> datetime.datetime:
+        return min(schedule.next_after(dt) for schedule in self.schedules)
+
+
+class Overlap(StrEnum):
+    # drop ticks that fire while the previous run is still going
+    SKIP = "skip"
+    # run once more right after the current run, however many ticks were missed
+    COALESCE = "coalesce"
+
+
+@dataclass(slots=True)
+class Job:
+    name: str
+    func: Callable[[], Awaitable[None]]
+    schedule: Schedule
+    overlap: Overlap = Overlap.COALESCE
+    # random delay added to every tick, in seconds
+    jitter: float = 0
+
+    _running: asyncio.Task | None = field(default=None, init=False, repr=False)
+    _pending: bool = field(default=False, init=False, repr=False)
+
+
+class Scheduler:
+    # upper bound for a single sleep, so wall clock adjustments are picked up
+    max_sleep = 3600
+
+    def __init__(self) -> None:
+        self.jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[None]],
+        schedule: Schedule,
+        *,
+        overlap: Overlap = Overlap.COALESCE,
+        jitter: float = 0,
+    ) -> Job:
+        if name in self.jobs:
+            msg = f"Job {name!r} already exists"
+            raise ValueError(msg)
+        job = Job(name, func, schedule, overlap, jitter)
+        self.jobs[name] = job
+        if self._tasks:
+            self._tasks.append(
+                asyncio.create_task(self._loop(job), name=f"scheduler-{name}")
+            )
+        return job
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._loop(job), name=f"scheduler-{job.name}")
+            for job in self.jobs.values()
+        ]
+
+    async def stop(self) -> None:
+        tasks: list[asyncio.Task] = [*self._tasks]
+        tasks.extend(job._running for job in self.jobs.values() if job._running)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks.clear()
+
+    def next_runs(self) -> dict[str, datetime.datetime]:
+        now = get_now()
+        return {name: job.schedule.next_after(now) for name, job in self.jobs.items()}
+
+    async def _loop(self, job: Job) -> None:
+        while True:
+            fire_at = job.schedule.next_after(get_now())
+            if job.jitter:
+                fire_at += datetime.timedelta(seconds=random.uniform(0, job.jitter))
+            while (delay := (fire_at - get_now()).total_seconds()) > 0:
+                await asyncio.sleep(min(delay, self.max_sleep))
+
+            if job._running is not None and not job._running.done():
+                if job.overlap is Overlap.SKIP:
+                    logging.warning("Job %s is still running, skipping tick", job.name)
+                else:
+                    job._pending = True
+                continue
+            job._running = asyncio.create_task(self._run(job), name=job.name)
+
+    @staticmethod
+    async def _run(job: Job) -> None:
+        while True:
+            job._pending = False
+            start = time.perf_counter()
+            try:
+                await job.func()
+            except Exception:
+                logging.exception("Job %s failed", job.name)
+            logging.info("Job %s took %.2fs", job.name, time.perf_counter() - start)
+            if not job._pending:
+                return
+            logging.info("Job %s missed ticks while running, running again", job.name)
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Protocol
+
+from .cache import TTLCache
+from .models import Stock
+
+if TYPE_CHECKING:
+    from .stock_index import StockIndex
+
+
+class StockLike(Protocol):
+    @property
+    def id(self) -> str: ...
+    @property
+    def name(self) -> str: ...
+
+
+@dataclass(frozen=True, slots=True)
+class StockInfo:
+    id: str
+    name: str
+
+    def __str__(self) -> str:
+        return f"[{self.id}] {self.name}"
+
+
+class StockDirectory:
+    """Stock metadata lookups by ID or name, served from memory when possible.
+
+    Hits live for ``ttl`` seconds, queries the fetcher could not resolve are
+    remembered for ``negative_ttl`` seconds, and concurrent lookups of the same
+    query share a single fetch.
+    """
+
+    def __init__(
+        self,
+        fetcher: Callable[[str], Awaitable[StockLike | None]],
+        *,
+        maxsize: int = 8192,
+        ttl: float = 24 * 60 * 60,
+        negative_ttl: float = 5 * 60,
+        index: "StockIndex | None" = None,
+    ) -> None:
+        self.fetcher = fetcher
+        self.index = index
+        self.negative_ttl = negative_ttl
+        self._stocks: TTLCache[str, StockInfo] = TTLCache(maxsize, ttl)
+        self._misses: TTLCache[str, bool] = TTLCache(maxsize, negative_ttl)
+        self._inflight: dict[str, asyncio.Future[StockInfo | None]] = {}
+
+    async def preload(self) -> None:
+        stocks = await Stock.all().values_list("id", "name")
+        for stock_id, name in stocks:
+            self.add(StockInfo(stock_id, name))
+        logging.info("Preloaded %d stocks into the stock directory", len(stocks))
+
+    def add(self, stock: StockLike) -> StockInfo:
+        info = StockInfo(stock.id, stock.name)
+        self._stocks.set(info.id, info)
+        self._stocks.set(info.name, info)
+        self._misses.pop(info.id)
+        self._misses.pop(info.name)
+        if self.index is not None:
+            self.index.add(info)
+        return info
+
+    def get_cached(self, query: str) -> StockInfo | None:
+        return self._stocks.get(query.strip())
+
+    async def get(self, query: str) -> StockInfo | None:
+        query = query.strip()
+        if (info := self._stocks.get(query)) is not None:
+            return info
+        if self._misses.get(query):
+            return None
+        if (future := self._inflight.get(query)) is not None:
+            return await future
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[query] = future
+        try:
+            stock = await self.fetcher(query)
+        except Exception as e:
+            future.set_exception(e)
+            # the exception is re-raised below, don't warn about it being unretrieved
+            future.exception()
+            raise
+        else:
+            info = None if stock is None else self.add(stock)
+            if info is None:
+                self._misses.set(query, True)
+            future.set_result(info)
+            return info
+        finally:
+            del self._inflight[query]
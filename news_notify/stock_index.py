@@ -0,0 +1,170 @@
+import bisect
+import heapq
+import logging
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+from difflib import SequenceMatcher
+
+import aiohttp
+
+from .stock_directory import StockInfo, StockLike
+
+# listed (TWSE) and OTC (TPEx) daily quotes, used as the list of all companies
+UNIVERSE_URLS = (
+    "https://openapi.twse.com.tw/v1/exchangeReport/STOCK_DAY_ALL",
+    "https://www.tpex.org.tw/openapi/v1/tpex_mainboard_quotes",
+)
+
+
+def _ngrams(text: str) -> set[str]:
+    text = text.casefold()
+    return set(text) | {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+class StockIndex:
+    """In-memory search over stock IDs and names.
+
+    IDs are matched by prefix, names by substring through a unigram/bigram
+    inverted index (works for CJK without any segmentation), and when nothing
+    matches, candidates sharing n-grams or one-edit ID variants are ranked by
+    similarity.
+    """
+
+    def __init__(self) -> None:
+        self._stocks: dict[str, StockInfo] = {}
+        self._by_name: dict[str, StockInfo] = {}
+        self._sorted_ids: list[str] = []
+        self._postings: defaultdict[str, set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._stocks)
+
+    def add(self, stock: StockLike) -> None:
+        old = self._stocks.get(stock.id)
+        if old is not None:
+            if old.name == stock.name:
+                return
+            self._remove_name(old)
+        else:
+            bisect.insort(self._sorted_ids, stock.id)
+
+        info = StockInfo(stock.id, stock.name)
+        self._stocks[info.id] = info
+        self._by_name[info.name.casefold()] = info
+        for gram in _ngrams(info.name):
+            self._postings[gram].add(info.id)
+
+    def update(self, stocks: Iterable[StockLike]) -> None:
+        for stock in stocks:
+            self.add(stock)
+
+    def _remove_name(self, stock: StockInfo) -> None:
+        self._by_name.pop(stock.name.casefold(), None)
+        for gram in _ngrams(stock.name):
+            self._postings[gram].discard(stock.id)
+
+    def get(self, query: str) -> StockInfo | None:
+        query = query.strip()
+        return self._stocks.get(query) or self._by_name.get(query.casefold())
+
+    def search(self, query: str, *, limit: int | None = 10) -> list[StockInfo]:
+        query = query.strip()
+        if not query:
+            return []
+        folded = query.casefold()
+
+        ids: list[str] = []
+        # ID prefix matches, shortest (i.e. exact) first
+        start = bisect.bisect_left(self._sorted_ids, query)
+        for stock_id in self._sorted_ids[start:]:
+            if not stock_id.startswith(query):
+                break
+            ids.append(stock_id)
+        ids.sort(key=len)
+
+        # name substring matches, prefix matches and shorter names first
+        grams = _ngrams(folded)
+        if len(folded) > 1:
+            grams = {gram for gram in grams if len(gram) == 2}
+        candidates = set.intersection(
+            *(self._postings.get(gram, set()) for gram in grams)
+        )
+        matches = (
+            stock_id
+            for stock_id in candidates
+            if folded in self._stocks[stock_id].name.casefold()
+        )
+
+        def rank(stock_id: str) -> tuple[bool, int, str]:
+            name = self._stocks[stock_id].name
+            return (not name.casefold().startswith(folded), len(name), stock_id)
+
+        name_ids = (
+            sorted(matches, key=rank)
+            if limit is None
+            else heapq.nsmallest(limit, matches, key=rank)
+        )
+        seen = set(ids)
+        ids.extend(stock_id for stock_id in name_ids if stock_id not in seen)
+
+        if not ids:
+            ids = self._fuzzy(folded)
+        return [self._stocks[stock_id] for stock_id in ids[:limit]]
+
+    def _fuzzy(self, query: str) -> list[str]:
+        # only the stocks sharing the most n-grams are scored precisely
+        overlap: Counter[str] = Counter()
+        for gram in _ngrams(query):
+            overlap.update(self._postings.get(gram, ()))
+        candidates = {stock_id for stock_id, _ in overlap.most_common(50)}
+        if query.isdigit():
+            candidates |= {
+                variant for variant in _edits(query) if variant in self._stocks
+            }
+
+        def score(stock_id: str) -> float:
+            stock = self._stocks[stock_id]
+            return max(
+                SequenceMatcher(None, query, stock.id).ratio(),
+                SequenceMatcher(None, query, stock.name.casefold()).ratio(),
+            )
+
+        scored = [(score(stock_id), stock_id) for stock_id in candidates]
+        return [
+            stock_id
+            for ratio, stock_id in sorted(scored, key=lambda item: (-item[0], item[1]))
+            if ratio >= 0.5
+        ]
+
+
+def _edits(stock_id: str) -> set[str]:
+    digits = "0123456789"
+    splits = [(stock_id[:i], stock_id[i:]) for i in range(len(stock_id) + 1)]
+    deletes = {left + right[1:] for left, right in splits if right}
+    transposes = {
+        left + right[1] + right[0] + right[2:]
+        for left, right in splits
+        if len(right) > 1
+    }
+    replaces = {left + c + right[1:] for left, right in splits if right for c in digits}
+    inserts = {left + c + right for left, right in splits for c in digits}
+    return deletes | transposes | replaces | inserts
+
+
+async def fetch_stock_universe(session: aiohttp.ClientSession) -> list[StockInfo]:
+    stocks: list[StockInfo] = []
+    for url in UNIVERSE_URLS:
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                rows = await resp.json(content_type=None)
+        except (aiohttp.ClientError, TimeoutError, ValueError):
+            logging.exception("Failed to fetch stock list from %s", url)
+            continue
+
+        for row in rows:
+            stock_id = row.get("Code") or row.get("SecuritiesCompanyCode")
+            name = row.get("Name") or row.get("CompanyName")
+            if stock_id and name:
+                stocks.append(StockInfo(stock_id.strip(), name.strip()))
+    return stocks
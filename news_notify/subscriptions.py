@@ -0,0 +1,113 @@
+import logging
+import time
+from collections import defaultdict
+from collections.abc import Callable
+
+from .db import read_db
+from .models import User
+
+
+class SubscriberIndex:
+    """In-memory stock -> {user_id: webhook url} map of users who can be notified.
+
+    The bot keeps it up to date as users change their subscriptions or webhook,
+    and ``reconcile`` reloads it from the database to pick up changes made
+    elsewhere (e.g. by the API process). Changes made here within ``replica_lag``
+    seconds before a reload are replayed over it, so a snapshot that predates
+    them can't undo them.
+    """
+
+    def __init__(self, *, replica_lag: float = 60) -> None:
+        self.replica_lag = replica_lag
+        # every subscription, whether the user has a webhook or not
+        self._stocks_by_user: defaultdict[str, set[str]] = defaultdict(set)
+        self._webhooks: dict[str, str] = {}
+        # only users with a webhook
+        self._by_stock: defaultdict[str, dict[str, str]] = defaultdict(dict)
+        # (monotonic time, change) of the changes made here, for reloads
+        self._changes: list[tuple[float, Callable[[SubscriberIndex], None]]] = []
+
+    def subscribers(self, stock_id: str) -> dict[str, str]:
+        return self._by_stock.get(stock_id, {})
+
+    def subscribe(self, user_id: str, stock_id: str) -> None:
+        self._apply(lambda index: index._subscribe(user_id, stock_id))
+
+    def unsubscribe(self, user_id: str, stock_id: str) -> None:
+        self._apply(lambda index: index._unsubscribe(user_id, stock_id))
+
+    def set_webhook(self, user_id: str, url: str | None) -> None:
+        self._apply(lambda index: index._set_webhook(user_id, url))
+
+    def _apply(self, change: Callable[["SubscriberIndex"], None]) -> None:
+        change(self)
+        self._changes.append((time.monotonic(), change))
+
+    def _subscribe(self, user_id: str, stock_id: str) -> None:
+        self._stocks_by_user[user_id].add(stock_id)
+        if (url := self._webhooks.get(user_id)) is not None:
+            self._by_stock[stock_id][user_id] = url
+
+    def _unsubscribe(self, user_id: str, stock_id: str) -> None:
+        self._stocks_by_user[user_id].discard(stock_id)
+        self._by_stock[stock_id].pop(user_id, None)
+
+    def _set_webhook(self, user_id: str, url: str | None) -> None:
+        if url is None:
+            self._webhooks.pop(user_id, None)
+            for stock_id in self._stocks_by_user[user_id]:
+                self._by_stock[stock_id].pop(user_id, None)
+        else:
+            self._webhooks[user_id] = url
+            for stock_id in self._stocks_by_user[user_id]:
+                self._by_stock[stock_id][user_id] = url
+
+    @staticmethod
+    async def _build() -> "SubscriberIndex":
+        index = SubscriberIndex()
+        rows = (
+            await User.all()
+            .using_db(read_db())
+            .values_list("id", "line_notify_token", "stocks__id")
+        )
+        for user_id, url, stock_id in rows:
+            if url is not None:
+                index._webhooks[user_id] = url
+            if stock_id is not None:
+                index._subscribe(user_id, stock_id)
+        return index
+
+    def _snapshot(self) -> set[tuple[str, str, str]]:
+        return {
+            (stock_id, user_id, url)
+            for stock_id, users in self._by_stock.items()
+            for user_id, url in users.items()
+        }
+
+    def _replace(self, index: "SubscriberIndex") -> None:
+        self._stocks_by_user = index._stocks_by_user
+        self._webhooks = index._webhooks
+        self._by_stock = index._by_stock
+
+    async def _reload(self) -> "SubscriberIndex":
+        started = time.monotonic()
+        index = await self._build()
+        # changes made while the snapshot was read, or shortly before on a
+        # lagging replica, may be missing from it
+        self._changes = [
+            (at, change)
+            for at, change in self._changes
+            if at >= started - self.replica_lag
+        ]
+        for _, change in self._changes:
+            change(index)
+        return index
+
+    async def load(self) -> None:
+        self._replace(await self._reload())
+
+    async def reconcile(self) -> None:
+        index = await self._reload()
+        if drift := len(self._snapshot() ^ index._snapshot()):
+            logging.info("Subscriber index was off by %d entries, reloaded", drift)
+        self._replace(index)
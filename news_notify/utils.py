@@ -1,10 +1,13 @@
+import asyncio
 import datetime
+import time
+from collections.abc import Iterable
 from typing import TypeVar
 
-import aiohttp
-
 T = TypeVar("T")
 
+TAIPEI = datetime.timezone(datetime.timedelta(hours=8))
+
 
 def split_list[T](input_list: list[T], n: int) -> list[list[T]]:
     if n <= 0:
@@ -15,7 +18,7 @@ def split_list[T](input_list: list[T], n: int) -> list[list[T]]:
 
 
 def get_now() -> datetime.datetime:
-    return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+    return datetime.datetime.now(TAIPEI)
 
 
 def get_today() -> datetime.date:
@@ -28,6 +31,28 @@ def shorten(text: str, max_length: int = 60) -> str:
     return text
 
 
-async def send_webhook(message: str, *, url: str) -> None:
-    async with aiohttp.ClientSession() as session:
-        await session.post(url, json={"content": message})
+def percentile(values: Iterable[float], q: float) -> float:
+    """The ``q`` quantile of ``values`` (nearest rank), 0 if there are none."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class RateLimiter:
+    """Spaces calls to ``wait`` so at most ``rate`` of them return per second."""
+
+    def __init__(self, rate: float) -> None:
+        if rate <= 0:
+            msg = "Parameter rate must be positive"
+            raise ValueError(msg)
+        self.interval = 1 / rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            delay = self._next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_at = max(self._next_at, time.monotonic()) + self.interval
@@ -0,0 +1,191 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .messages import Payload
+from .metrics import WEBHOOK_RESPONSES, WEBHOOK_SECONDS
+from .utils import get_now
+
+
+@dataclass(slots=True)
+class WebhookResult:
+    url: str
+    status: int | None
+    latency: float
+    attempts: int
+    error: str | None = None
+    # when the first request went out and when a 2xx response came back
+    sent_at: datetime.datetime | None = None
+    acked_at: datetime.datetime | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status is not None and 200 <= self.status < 300
+
+
+class WebhookSender:
+    """Long-lived Discord webhook client with a shared keep-alive connection pool.
+
+    Sends are bounded by ``concurrency`` overall and ``per_host_concurrency`` per
+    destination host. A 429 only pauses the webhook that received it.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = 100,
+        per_host_concurrency: int = 50,
+        timeout: float = 10,
+        max_attempts: int = 3,
+    ) -> None:
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._host_semaphores: defaultdict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(per_host_concurrency)
+        )
+        # webhook url -> monotonic time before which it must not be called
+        self._retry_at: dict[str, float] = {}
+
+    async def start(self) -> None:
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.per_host_concurrency,
+            keepalive_timeout=60,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            msg = "WebhookSender.start() must be awaited before sending"
+            raise RuntimeError(msg)
+        return self._session
+
+    async def send(self, message: str | bytes | Payload, *, url: str) -> WebhookResult:
+        """Send a text message, a JSON payload or an already encoded JSON body."""
+        if isinstance(message, str):
+            message = {"content": message}
+        body = (
+            message
+            if isinstance(message, bytes)
+            else json.dumps(message, ensure_ascii=False).encode()
+        )
+        host = urlsplit(url).netloc
+        start = time.perf_counter()
+        status: int | None = None
+        error: str | None = None
+        sent_at: datetime.datetime | None = None
+
+        attempt = 0
+        while attempt < self.max_attempts:
+            attempt += 1
+            await self._wait_for_rate_limit(url)
+            try:
+                async with self._semaphore, self._host_semaphores[host]:
+                    sent_at = sent_at or get_now()
+                    async with self.session.post(
+                        url, data=body, headers={"Content-Type": "application/json"}
+                    ) as resp:
+                        status = resp.status
+                        WEBHOOK_RESPONSES.inc(status=str(status))
+                        if status == 429:
+                            delay = await self._get_retry_after(resp)
+                            error = f"rate limited for {delay}s"
+                        elif status >= 500:
+                            delay = 2 ** (attempt - 1)
+                            error = await resp.text()
+                        else:
+                            error = None if resp.ok else await resp.text()
+                            break
+            except (aiohttp.ClientError, TimeoutError) as e:
+                status, error = None, repr(e)
+                WEBHOOK_RESPONSES.inc(status="error")
+                delay = 2 ** (attempt - 1)
+
+            # only this webhook backs off, other destinations keep sending
+            self._retry_at[url] = time.monotonic() + delay
+
+        result = WebhookResult(
+            url=url,
+            status=status,
+            latency=time.perf_counter() - start,
+            attempts=attempt,
+            error=error,
+            sent_at=sent_at,
+        )
+        if result.ok:
+            result.acked_at = get_now()
+        WEBHOOK_SECONDS.observe(result.latency, result="ok" if result.ok else "failed")
+        if not result.ok:
+            logging.warning(
+                "Webhook to %s failed after %d attempts: %s %s",
+                host,
+                result.attempts,
+                result.status,
+                result.error,
+            )
+        return result
+
+    async def send_many(
+        self, deliveries: Iterable[tuple[str | bytes | Payload, str]]
+    ) -> list[WebhookResult]:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(self.send(message, url=url) for message, url in deliveries)
+        )
+        if results:
+            latencies = sorted(result.latency for result in results)
+            logging.info(
+                "Sent %d webhooks (%d failed) in %.2fs, p50 %.3fs, max %.3fs",
+                len(results),
+                sum(not result.ok for result in results),
+                time.perf_counter() - start,
+                latencies[len(latencies) // 2],
+                latencies[-1],
+            )
+        return results
+
+    async def _wait_for_rate_limit(self, url: str) -> None:
+        retry_at = self._retry_at.get(url)
+        if retry_at is None:
+            return
+        delay = retry_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self._retry_at.pop(url, None)
+
+    @staticmethod
+    async def _get_retry_after(resp: aiohttp.ClientResponse) -> float:
+        header = resp.headers.get("Retry-After")
+        if header is not None:
+            try:
+                return float(header)
+            except ValueError:
+                pass
+        try:
+            data = await resp.json()
+        except (aiohttp.ContentTypeError, ValueError):
+            return 1.0
+        return float(data.get("retry_after", 1.0))
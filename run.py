@@ -15,7 +15,19 @@ async def main() -> None:
         msg = "LINE_CHANNEL_SECRET and LINE_ACCESS_TOKEN are required."
         raise RuntimeError(msg)
 
-    bot = NewsNotify(channel_secret, access_token, db_url=os.getenv("DB_URL"))
+    crawl_interval = os.getenv("CRAWL_INTERVAL")
+    metrics_port = os.getenv("METRICS_PORT")
+    bot = NewsNotify(
+        channel_secret,
+        access_token,
+        db_url=os.getenv("DB_URL"),
+        read_db_url=os.getenv("DB_READ_URL"),
+        crawl_interval=float(crawl_interval) if crawl_interval else None,
+        persist_conversations=os.getenv("PERSIST_CONVERSATIONS") == "1",
+        run_outbox=os.getenv("RUN_OUTBOX", "1") == "1",
+        queue_events=os.getenv("QUEUE_EVENTS") == "1",
+        metrics_port=int(metrics_port) if metrics_port else None,
+    )
     await bot.run(port=8001)
 
 
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from tortoise import Tortoise, connections
+
+from news_notify.db import init_db
+from news_notify.messages import MessageRenderer
+from news_notify.metrics import (
+    instrument_queries,
+    monitor_event_loop,
+    start_metrics_server,
+)
+from news_notify.migrations import wait_for_schema
+from news_notify.outbox import Outbox, worker_shards
+from news_notify.webhook import WebhookSender
+
+load_dotenv()
+
+
+async def main() -> None:
+    # pm2 numbers the instances of a scaled app through NODE_APP_INSTANCE
+    index = int(os.getenv("WORKER_INDEX") or os.getenv("NODE_APP_INSTANCE") or 0)
+    count = int(os.getenv("WORKER_COUNT") or 1)
+    shards = worker_shards(index, count)
+
+    await init_db(os.getenv("DB_URL"))
+    instrument_queries(connections.get("default"))
+    # the bot process owns the schema and its migrations
+    await wait_for_schema()
+    webhook = WebhookSender()
+    await webhook.start()
+    # other processes enqueue, so new deliveries are only seen by polling
+    outbox = Outbox(
+        webhook,
+        renderer=MessageRenderer(),
+        shards=shards,
+        poll_interval=float(os.getenv("WORKER_POLL_INTERVAL") or 2),
+    )
+    outbox.start()
+    logging.info("Worker %d/%d delivering shards %s", index + 1, count, shards)
+
+    # each worker serves its own metrics, on METRICS_PORT + its index
+    metrics_server = None
+    if metrics_port := os.getenv("METRICS_PORT"):
+        metrics_server = await start_metrics_server(int(metrics_port) + index)
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        loop_monitor.cancel()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await outbox.stop()
+        await webhook.close()
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    asyncio.run(main())